@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+BenchmarkDownload.py
+
+Measure the GetVideoKMG.py downloader offline against the local mock CDN (MockCdn.py).
+Each scenario downloads the synthetic clip with write_chunks (video track only) and with
+get_video (both tracks and merge) and reports MiB/s, requests/s and the p50/p99 segment
+latency seen by the server. Downloaded files are checked against the expected bytes.
+
+Usage:
+  python BenchmarkDownload.py --workers 1,4,8 --latency 0.05 --jitter 0.02 --bandwidth 2
+  python BenchmarkDownload.py --workers 8 --max-span 16 --failure-rate 0.02 --json bench.json
+  python BenchmarkDownload.py --workers 1 --duration 6 --limit-rate 512K --deadline 2
+
+Notes:
+- The synthetic segments are not a real video, so get_video merges with a null muxer
+  which copies the video and then the audio into the output file, instead of ffmpeg.
+- Connections and segment latency history are reset between scenarios.
+- With --limit-rate, segments slower than --deadline because of the rate limit must
+  still be downloaded: the time waiting for the limit does not count in the deadline.
+"""
+
+import argparse
+import json
+import logging
+import os
+import stat
+import sys
+import tempfile
+import time
+
+import GetVideoKMG
+import HttpTransport
+import MockCdn
+import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Takes the place of ffmpeg: copies the -i inputs one after the other into the output file
+NULL_MUXER = """#!{python}
+import sys
+args = sys.argv[1:]
+inputs = [args[index + 1] for index, arg in enumerate(args) if arg == "-i"]
+with open(args[-1], "wb") as out:
+    for path in inputs:
+        with open(path, "rb") as media:
+            while True:
+                block = media.read(1024 * 1024)
+                if not block:
+                    break
+                out.write(block)
+"""
+
+#
+# Value at the given percentile of a list of samples, None if empty
+#
+def percentile(samples, percent):
+
+    if not samples:
+        return None
+
+    ordered = sorted(samples)
+
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+#
+# Write the null muxer into workfolder and return its path
+#
+def install_null_muxer(workfolder):
+
+    muxerpath = os.path.join(workfolder, "null_muxer.py")
+
+    with open(muxerpath, "w", encoding="utf-8") as file:
+        file.write(NULL_MUXER.format(python=sys.executable))
+
+    os.chmod(muxerpath, os.stat(muxerpath).st_mode | stat.S_IXUSR)
+
+    return muxerpath
+
+#
+# Start a measure from a clean state: no file left by a previous scenario, no open connection,
+# no latency history, no server counters
+#
+def reset_state(server, workfolder):
+
+    for filename in os.listdir(workfolder):
+        if filename.startswith(("write_chunks", "get_video")):
+            os.remove(os.path.join(workfolder, filename))
+
+    HttpTransport.close()
+    GetVideoKMG.segment_latencies = GetVideoKMG.LatencyTracker()
+    server.stats.reset()
+
+#
+# Build the result of a scenario from its elapsed time and the server counters
+#
+def scenario_result(name, workers, elapsed, server, verified):
+
+    stats = server.stats.snapshot()
+
+    p50 = percentile(stats['latencies'], 50)
+    p99 = percentile(stats['latencies'], 99)
+
+    return {
+        'scenario': name,
+        'workers': workers,
+        'seconds': elapsed,
+        'bytes': stats['bytes'],
+        'mib_per_s': stats['bytes'] / elapsed / (1024 * 1024) if elapsed else 0,
+        'requests': stats['requests'],
+        'failures': stats['failures'],
+        'requests_per_s': stats['requests'] / elapsed if elapsed else 0,
+        'p50_ms': p50 * 1000 if p50 is not None else None,
+        'p99_ms': p99 * 1000 if p99 is not None else None,
+        'verified': verified,
+    }
+
+#
+# Download the video track of the clip with write_chunks into workfolder
+#
+def bench_write_chunks(server, url, workfolder, workers, max_span):
+
+    video = GetVideoKMG.prepare_video(os.path.join(workfolder, "write_chunks.mp4"), url, {})
+
+    if video is None:
+        return None
+
+    _, filepath, init_binary, chunks, chunk_base_url = video['tracks'][0]
+
+    reset_state(server, workfolder)
+
+    start = time.monotonic()
+    result = GetVideoKMG.write_chunks(filepath, init_binary, chunks, chunk_base_url, {}, workers, max_span)
+    elapsed = time.monotonic() - start
+
+    verified = False
+
+    if result:
+        with open(filepath, "rb") as file:
+            data = file.read()
+        verified = data == MockCdn.expected_body(len(data))
+
+    return scenario_result("write_chunks", workers, elapsed, server, verified)
+
+#
+# Download and merge the clip with get_video into workfolder
+#
+def bench_get_video(server, url, workfolder, workers, max_span, stream):
+
+    outputfilepath = os.path.join(workfolder, "get_video.mp4")
+
+    # Sizes of the tracks chosen by get_video, to check the merged file
+    video = GetVideoKMG.prepare_video(outputfilepath, url, {})
+
+    if video is None:
+        return None
+
+    sizes = [GetVideoKMG.chunk_offsets(track[2], track[3])[1] for track in video['tracks']]
+
+    reset_state(server, workfolder)
+
+    start = time.monotonic()
+    result = GetVideoKMG.get_video(outputfilepath, url, {}, workers, max_span, stream)
+    elapsed = time.monotonic() - start
+
+    verified = False
+
+    if result:
+        with open(outputfilepath, "rb") as file:
+            data = file.read()
+        verified = data == b"".join(MockCdn.expected_body(size) for size in sizes)
+
+    return scenario_result("get_video stream" if stream else "get_video", workers, elapsed, server, verified)
+
+
+def print_results(results):
+
+    print(f"{'scenario':<18}{'workers':>8}{'MiB/s':>9}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'fail':>6}  ok")
+
+    for result in results:
+        p50 = f"{result['p50_ms']:.1f}" if result['p50_ms'] is not None else "-"
+        p99 = f"{result['p99_ms']:.1f}" if result['p99_ms'] is not None else "-"
+        print(f"{result['scenario']:<18}{result['workers']:>8}{result['mib_per_s']:>9.2f}{result['requests_per_s']:>9.1f}"
+              f"{p50:>9}{p99:>9}{result['failures']:>6}  {result['verified']}")
+
+
+def main(args):
+
+    logging.basicConfig(format='%(asctime)s-%(name)s-%(levelname)s:%(message)s',
+                        level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    server = MockCdn.start(playlist=MockCdn.synthetic_playlist(duration=args.duration, seed=args.seed),
+                           latency=args.latency, jitter=args.jitter,
+                           bandwidth=args.bandwidth * 1024 * 1024, link_bandwidth=args.link_bandwidth * 1024 * 1024,
+                           failure_rate=args.failure_rate, max_range=args.max_range * 1024 * 1024, seed=args.seed)
+
+    url = MockCdn.playlist_url(server)
+
+    if args.deadline:
+        GetVideoKMG.SEGMENT_DEADLINE = args.deadline
+
+    GetVideoKMG.bandwidth = RateLimiter.RateLimiter(RateLimiter.parse_rate(args.limit_rate))
+
+    workers_list = [int(value) for value in args.workers.split(",")]
+    max_span = args.max_span * 1024 * 1024
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workfolder:
+
+        GetVideoKMG.FFMPEG_BIN_PATH = install_null_muxer(workfolder)
+
+        for _ in range(args.repeat):
+
+            for workers in workers_list:
+
+                results.append(bench_write_chunks(server, url, workfolder, workers, max_span))
+                results.append(bench_get_video(server, url, workfolder, workers, max_span, False))
+
+                if args.stream:
+                    results.append(bench_get_video(server, url, workfolder, workers, max_span, True))
+
+    server.shutdown()
+
+    # A scenario without result could not get the playlist
+    results = [result for result in results if result is not None]
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+
+    return all(result['verified'] for result in results)
+
+
+# main program
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", default="1,4,8", help="Comma separated numbers of segment workers to measure (default 1,4,8)")
+    parser.add_argument("-m", "--max-span", type=int, default=0, help="Merge contiguous segments into range requests of at most this size in MiB (default 0)")
+    parser.add_argument("-s", "--stream", action='store_true', help="Also measure get_video streaming into ffmpeg")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of times each scenario is run (default 1)")
+    parser.add_argument("--duration", type=int, default=MockCdn.DURATION, help="Duration in seconds of the synthetic clip (default 60)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds before each answer (default 0.02)")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Random variation in seconds of the latency (default 0.01)")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Maximum MiB/s of one response, 0 for no limit (default 0)")
+    parser.add_argument("--link-bandwidth", type=float, default=0, help="Maximum MiB/s of all responses, 0 for no limit (default 0)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of segment requests answered with 503 (default 0)")
+    parser.add_argument("--max-range", type=int, default=0, help="Mock CDN refuses ranges larger than this size in MiB, 0 for no limit (default 0)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic playlist and of the injected faults (default 0)")
+    parser.add_argument("--limit-rate", help="Download rate limit of GetVideoKMG with an optional K, M or G suffix (default no limit)")
+    parser.add_argument("--deadline", type=int, help="Maximum seconds to download one segment (default GetVideoKMG's)")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+    parser.add_argument("-v", "--verbose", action='store_true', help="Show the downloader logs")
+
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args) else 1)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+BenchmarkHashRead.py
+
+Measure the read strategies of CompareFilesInFolders.hash_file (readinto a reused buffer,
+mmap, read) for several block sizes. Each scenario hashes the files and reports MiB/s,
+the CPU time and the growth of the page cache during the run. All the scenarios must
+find the same hashes.
+
+Usage:
+  python BenchmarkHashRead.py --size 512 --block-sizes 64,1024,4096 --repeat 3
+  python BenchmarkHashRead.py /mnt/nuc/Videos/a.mp4 /mnt/nuc/Videos/b.mp4 --warm --keep-cache
+
+Notes:
+- Without files, a temporary file of --size MiB of random bytes is hashed.
+- By default each run starts cold: the files are dropped from the page cache first,
+  which only works for pages not modified since the last write to disk. With --warm,
+  the files are read once before measuring and stay in the cache (use --keep-cache).
+- The page cache growth is the difference of Cached in /proc/meminfo, so other programs
+  running at the same time change it. It is only available on Linux.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import CompareFilesInFolders
+
+# Size of the blocks written into the temporary file
+WRITE_BLOCK_SIZE = 4 * 1024 * 1024
+
+#
+# Size in bytes of the page cache, None if unknown (not Linux)
+#
+def cached_bytes():
+
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+#
+# Drop the files from the page cache so the next read comes from the disk
+#
+def drop_from_cache(paths):
+
+    for path in paths:
+        with open(path, "rb") as file:
+            CompareFilesInFolders._advise(file.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+
+#
+# Write a file of size bytes of random data into workfolder and return its path
+#
+def make_sample(workfolder, size):
+
+    samplepath = os.path.join(workfolder, "sample.bin")
+
+    with open(samplepath, "wb") as file:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(WRITE_BLOCK_SIZE, remaining))
+            file.write(block)
+            remaining -= len(block)
+        file.flush()
+        os.fsync(file.fileno())
+
+    return samplepath
+
+#
+# Hash the files with one strategy and block size, and measure the run
+#
+def bench_read(paths, algo, strategy, block_size, warm):
+
+    if warm:
+        for path in paths:
+            CompareFilesInFolders.hash_file(path, algo, "read", block_size)
+    else:
+        drop_from_cache(paths)
+
+    cached_before = cached_bytes()
+
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    hashes = [CompareFilesInFolders.hash_file(path, algo, strategy, block_size) for path in paths]
+    cpu = time.process_time() - cpu_start
+    elapsed = time.monotonic() - start
+
+    cached_after = cached_bytes()
+
+    total = sum(os.path.getsize(path) for path in paths)
+
+    return {
+        'strategy': strategy,
+        'block_kib': block_size // 1024,
+        'seconds': elapsed,
+        'cpu_seconds': cpu,
+        'bytes': total,
+        'mib_per_s': total / elapsed / (1024 * 1024) if elapsed else 0,
+        'cache_mib': (cached_after - cached_before) / (1024 * 1024) if cached_before is not None else None,
+        'hashes': hashes,
+    }
+
+
+def print_results(results):
+
+    print(f"{'strategy':<10}{'block KiB':>10}{'MiB/s':>10}{'CPU s':>8}{'cache MiB':>11}")
+
+    for result in results:
+        cache = f"{result['cache_mib']:+.0f}" if result['cache_mib'] is not None else "-"
+        print(f"{result['strategy']:<10}{result['block_kib']:>10}{result['mib_per_s']:>10.1f}"
+              f"{result['cpu_seconds']:>8.2f}{cache:>11}")
+
+
+def main(args):
+
+    strategies = args.strategies.split(",")
+    block_sizes = [int(value) * 1024 for value in args.block_sizes.split(",")]
+
+    for strategy in strategies:
+        if strategy not in CompareFilesInFolders.READ_STRATEGIES:
+            print(f"Unknown strategy {strategy}, expected one of {', '.join(CompareFilesInFolders.READ_STRATEGIES)}",
+                  file=sys.stderr)
+            return False
+
+    CompareFilesInFolders.DROP_CACHE = not args.keep_cache
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as workfolder:
+
+        paths = args.files or [make_sample(workfolder, args.size * 1024 * 1024)]
+
+        for _ in range(args.repeat):
+
+            for block_size in block_sizes:
+
+                for strategy in strategies:
+
+                    results.append(bench_read(paths, args.algo, strategy, block_size, args.warm))
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({'settings': vars(args), 'results': results}, file, indent=2)
+
+    # Every strategy must read the same bytes
+    same = all(result['hashes'] == results[0]['hashes'] for result in results)
+
+    if not same:
+        print("Hashes differ between scenarios", file=sys.stderr)
+
+    return same
+
+
+# main program
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", help="Files to hash (default: a temporary file of --size MiB)")
+    parser.add_argument("--size", type=int, default=256, help="Size in MiB of the temporary file (default 256)")
+    parser.add_argument("-s", "--strategies", default="readinto,mmap,read", help="Comma separated read strategies to measure (default readinto,mmap,read)")
+    parser.add_argument("-b", "--block-sizes", default="64,1024,4096", help="Comma separated block sizes in KiB to measure (default 64,1024,4096)")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Number of times each scenario is run (default 1)")
+    parser.add_argument("--algo", default="sha256", help="Hash algorithm (default sha256)")
+    parser.add_argument("--warm", action='store_true', help="Read the files before each run instead of dropping them from the page cache")
+    parser.add_argument("--keep-cache", action='store_true', help="Do not drop the files from the page cache while hashing")
+    parser.add_argument("--json", help="Write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args) else 1)
@@ -9,67 +9,547 @@ If a file has no content match on the other side, the opposite column is left bl
 Usage:
   python compare_by_content.py /path/to/dirA /path/to/dirB --csv out.csv
   python compare_by_content.py dirA dirB --csv out.csv --algo sha256
+  python compare_by_content.py dirA dirB --csv out.csv --tiered
+  python compare_by_content.py dirA dirB --csv out.csv --cache ~/.cache/compare_hashes.db
+  python compare_by_content.py --cache ~/.cache/compare_hashes.db --prune
+  python compare_by_content.py dirA /mnt/nuc/dirB --csv out.csv --workers 2
+  python compare_by_content.py dirA dirB --csv out.csv --read mmap --block-size 4096
 
 Notes:
 - Matches are grouped by content hash; filenames/paths are ignored for matching.
 - Duplicates (same content multiple times on a side) are expanded into multiple rows.
+- With --tiered, only files with the size of a file on the other side are read: first
+  their head and tail, then the whole file if these match too. The rows are the same,
+  but the files whose size or head and tail are not found on the other side are
+  written after the matched groups, sorted by path, as their hash is not computed.
+- With --cache, hashes are kept in a SQLite database keyed by device, inode, size,
+  modification time and algorithm, so unchanged files are not read again by the next
+  comparisons. --prune removes the entries of files deleted or changed since.
+- Files are hashed by a pool of threads per device: SSD_WORKERS on an SSD,
+  ROTATIONAL_WORKERS on a spinning disk and NETWORK_WORKERS on a network mount
+  (CIFS, NFS...). Both directories are hashed at the same time, so they are read
+  in parallel when they are on different devices. --workers sets the same number
+  of threads on every device.
+- Files are read with readinto into a buffer reused by each thread (--read mmap maps
+  them instead), by blocks of --block-size KiB. They are read with the sequential
+  access hint and dropped from the page cache behind the reading, so a comparison
+  does not evict the videos being streamed by the same machine. --keep-cache leaves
+  them in the cache, for example to compare the same files again right after.
+  BenchmarkHashRead.py compares the read strategies and block sizes.
+- Both directories are walked with FileWalker.py, their folders listed in parallel
+  without a stat call per file, and each file is hashed as soon as it is found.
 """
 
 import argparse
 import hashlib
+import mmap
 import os
 import sys
 import csv
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from itertools import zip_longest
 
+import FileWalker
+
 CHUNK_SIZE = 1024 * 1024  # 1 MiB
 
-def hash_file(path: str, algo: str = "sha256") -> str:
+# Ways of reading the files to hash, see hash_file
+READ_STRATEGIES = ("readinto", "mmap", "read")
+READ_STRATEGY = "readinto"
+
+# Drop the files hashed from the page cache, so a scan of a whole library does not
+# evict the files used by other programs. Done every DROP_BEHIND bytes read
+DROP_CACHE = True
+DROP_BEHIND = 32 * 1024 * 1024
+
+# Bytes read at the start and at the end of a file for its partial hash (--tiered)
+PARTIAL_SIZE = 4 * 1024 * 1024
+
+# Hashes of files modified less than this number of seconds ago are not cached,
+# they may change again within the resolution of their modification time
+CACHE_MIN_AGE = 2
+
+# Number of new hashes written to the cache between two commits
+CACHE_COMMIT_EVERY = 500
+
+# Read buffers of the hashing threads
+_buffers = threading.local()
+
+
+class HashCache:
+    """
+    SQLite cache of file hashes, keyed by (device, inode, size, mtime_ns, algorithm, kind).
+    kind tells which bytes were hashed: "full", or "partial<n>" for the first and last n bytes.
+    Used from several threads.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = os.path.expandvars(os.path.expanduser(db_path))
+        folder = os.path.dirname(self.db_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER,
+                algo TEXT, kind TEXT, digest TEXT, path TEXT,
+                PRIMARY KEY (dev, ino, size, mtime_ns, algo, kind))""")
+        self.db.commit()
+
+    def digest(self, path: str, algo: str, kind: str, compute):
+        """
+        Return the cached hash of path, else compute() and cache its result.
+        """
+        st = os.stat(path)
+        # Some file systems have no inode numbers, their files cannot be identified
+        if not st.st_ino:
+            return compute()
+
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algo, kind)
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND algo=? AND kind=?",
+                key).fetchone()
+            if row is not None:
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+
+        h = compute()
+
+        if time.time_ns() - st.st_mtime_ns < CACHE_MIN_AGE * 1_000_000_000:
+            return h
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", key + (h, path))
+            self.pending += 1
+            if self.pending >= CACHE_COMMIT_EVERY:
+                self.db.commit()
+                self.pending = 0
+
+        return h
+
+    def prune(self):
+        """
+        Remove the entries of files deleted or changed since they were hashed.
+        Returns: (removed, kept)
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT rowid, path, dev, ino, size, mtime_ns FROM hashes").fetchall()
+
+        stale = []
+        for rowid, path, dev, ino, size, mtime_ns in rows:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append((rowid,))
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != (dev, ino, size, mtime_ns):
+                stale.append((rowid,))
+
+        with self.lock:
+            self.db.executemany("DELETE FROM hashes WHERE rowid=?", stale)
+            self.db.commit()
+            self.db.execute("VACUUM")
+
+        return len(stale), len(rows) - len(stale)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+# Hashing threads per device: network file systems and spinning disks are slowed down by
+# concurrent streams, SSDs need several requests in flight to reach their throughput
+NETWORK_WORKERS = 2
+ROTATIONAL_WORKERS = 1
+SSD_WORKERS = 8
+DEFAULT_WORKERS = 4
+
+NETWORK_FILESYSTEMS = ("cifs", "smb3", "smbfs", "nfs", "nfs4", "9p", "drvfs", "fuse.sshfs", "afs", "ceph", "glusterfs")
+
+
+def mount_type(path: str):
+    """
+    File system type of the mount holding path, None if unknown (not Linux).
+    """
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/self/mounts", encoding="utf-8") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces in mount points are written \\040
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        return None
+    return fstype
+
+
+def is_rotational(dev: int):
+    """
+    True for a spinning disk, False for an SSD, None if unknown.
+    """
+    block = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    # A partition has no queue of its own, the disk holding it has
+    for queue in (os.path.join(block, "queue", "rotational"), os.path.join(block, "..", "queue", "rotational")):
+        try:
+            with open(queue, encoding="utf-8") as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return None
+
+
+def device_workers(path: str) -> int:
+    """
+    Number of threads hashing files at the same time on the device holding path.
+    """
+    if mount_type(path) in NETWORK_FILESYSTEMS:
+        return NETWORK_WORKERS
+    try:
+        rotational = is_rotational(os.stat(path).st_dev)
+    except (OSError, AttributeError):
+        rotational = None
+    if rotational is None:
+        return DEFAULT_WORKERS
+    return ROTATIONAL_WORKERS if rotational else SSD_WORKERS
+
+
+class HashPool:
+    """
+    Thread pools hashing files, one per device with its own number of workers,
+    so files of different devices are read at the same time. hashlib releases
+    the GIL while hashing, the threads run in parallel.
+    """
+
+    def __init__(self, workers: int = None):
+        # Same number of workers on every device when set
+        self.workers = workers
+        self.pools = {}
+        # Number of workers of the pool of each device
+        self.sizes = {}
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def submit(self, path: str, fn, *args):
+        folder = os.path.dirname(path)
+        # The files of a folder are on its device, which is read once per folder
+        dev = self.devices.get(folder)
+        if dev is None:
+            dev = self.devices[folder] = os.stat(folder).st_dev
+        with self.lock:
+            if dev not in self.pools:
+                nb = self.workers or device_workers(path)
+                print(f"Hashing with {nb} threads on the device of {folder}")
+                self.pools[dev] = ThreadPoolExecutor(max_workers=nb)
+                self.sizes[dev] = nb
+            pool = self.pools[dev]
+        return pool.submit(fn, *args)
+
+    def capacity(self) -> int:
+        """
+        Number of files hashed at the same time by the pools of the devices found so far.
+        """
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _advise(fd: int, offset: int, length: int, advice: str):
+    # posix_fadvise is only a hint, and is missing on Windows and macOS
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def _read_buffer(size: int):
+    """
+    Buffer of size bytes and its memoryview, reused by all the files hashed by the calling thread.
+    """
+    if getattr(_buffers, "size", None) != size:
+        _buffers.buffer = bytearray(size)
+        _buffers.view = memoryview(_buffers.buffer)
+        _buffers.size = size
+    return _buffers.buffer, _buffers.view
+
+
+def hash_file(path: str, algo: str = "sha256", strategy: str = None, block_size: int = None) -> str:
+    """
+    Hash of the whole file, read by blocks of block_size bytes (CHUNK_SIZE by default) with
+    strategy (READ_STRATEGY by default):
+    - readinto: into a buffer reused by the thread, no new object per block
+    - mmap: mapped in memory and hashed in place, for files larger than one block
+    - read: a new bytes object per block
+    With DROP_CACHE, the pages read are dropped from the page cache every DROP_BEHIND bytes.
+    """
+    strategy = strategy or READ_STRATEGY
+    block_size = block_size or CHUNK_SIZE
     h = hashlib.new(algo)
-    with open(path, "rb") as f:
+
+    with open(path, "rb", buffering=0) as f:
+        fd = f.fileno()
+        _advise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+        if strategy == "mmap" and os.fstat(fd).st_size > block_size:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mm) as view:
+                    for offset in range(0, len(view), block_size):
+                        h.update(view[offset:offset + block_size])
+            # Mapped pages cannot be dropped, they are once unmapped
+            if DROP_CACHE:
+                _advise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+            return h.hexdigest()
+
+        if strategy != "read":
+            buffer, view = _read_buffer(block_size)
+
+        position = dropped = 0
         while True:
-            chunk = f.read(CHUNK_SIZE)
-            if not chunk:
+            if strategy == "read":
+                chunk = f.read(block_size)
+                n = len(chunk)
+            else:
+                n = f.readinto(buffer)
+                chunk = view[:n]
+            if not n:
                 break
             h.update(chunk)
+            position += n
+            if DROP_CACHE and position - dropped >= DROP_BEHIND:
+                _advise(fd, dropped, position - dropped, "POSIX_FADV_DONTNEED")
+                dropped = position
+
+        if DROP_CACHE:
+            _advise(fd, dropped, 0, "POSIX_FADV_DONTNEED")
+
     return h.hexdigest()
 
 
+def content_hash(path: str, algo: str = "sha256", cache: HashCache = None) -> str:
+    """
+    Hash of the whole file, from the cache when given and the file did not change.
+    """
+    if cache is None:
+        return hash_file(path, algo)
+    return cache.digest(path, algo, "full", lambda: hash_file(path, algo))
+
+
+def hash_head_tail(path: str, size: int, algo: str = "sha256") -> str:
+    h = hashlib.new(algo)
+    with open(path, "rb") as f:
+        h.update(f.read(PARTIAL_SIZE))
+        f.seek(size - PARTIAL_SIZE)
+        h.update(f.read(PARTIAL_SIZE))
+        if DROP_CACHE:
+            _advise(f.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+    return h.hexdigest()
+
+
+def partial_hash(path: str, size: int, algo: str = "sha256", cache: HashCache = None):
+    """
+    Hash of the first and last PARTIAL_SIZE bytes of a file of the given size.
+    Returns (hash, full): a file smaller than both parts is hashed whole, its
+    partial hash is then its content hash.
+    """
+    if size <= 2 * PARTIAL_SIZE:
+        return content_hash(path, algo, cache), True
+
+    if cache is None:
+        return hash_head_tail(path, size, algo), False
+    return cache.digest(path, algo, f"partial{PARTIAL_SIZE}", lambda: hash_head_tail(path, size, algo)), False
+
+
 def iter_files(root: str):
-    for dirpath, _, filenames in os.walk(root):
-        for name in filenames:
-            full = os.path.join(dirpath, name)
-            try:
-                if os.path.islink(full) or not os.path.isfile(full):
-                    continue
-            except OSError:
-                continue
-            yield full
+    for entry in FileWalker.walk_files(root):
+        yield entry.path
 
 
-def build_hash_index(root: str, algo: str):
+def _collect_hashes(futures: dict, done, hashes: dict):
     """
-    Returns: dict[hash] -> list[str] of absolute file paths
+    Move the hashes of the done futures from futures (future -> path) into hashes.
     """
-    idx = {}
-    for p in iter_files(root):
+    for future in done:
+        p = futures.pop(future)
         try:
-            h = hash_file(p, algo)
+            hashes[p] = future.result()
         except Exception as e:
             print(f"Warning: failed to hash {p}: {e}", file=sys.stderr)
-            continue
-        idx.setdefault(h, []).append(p)
+
+
+def hash_files(paths, hasher, pool: HashPool = None) -> dict:
+    """
+    Hash each path with hasher(path), in parallel on the pool when given. paths can be
+    a generator: with a pool, each path is hashed while the next ones are found.
+    At most twice as many files as the pool workers are queued at a time.
+    Returns: dict[path] -> hash, without the paths which cannot be read
+    """
+    hashes = {}
+
+    if pool is None:
+        for p in paths:
+            try:
+                hashes[p] = hasher(p)
+            except Exception as e:
+                print(f"Warning: failed to hash {p}: {e}", file=sys.stderr)
+        return hashes
+
+    futures = {}
+    for p in paths:
+        # The window grows with the pools of the devices found
+        while len(futures) >= 2 * max(1, pool.capacity()):
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            _collect_hashes(futures, done, hashes)
+        try:
+            futures[pool.submit(p, hasher, p)] = p
+        except OSError as e:
+            print(f"Warning: failed to hash {p}: {e}", file=sys.stderr)
+
+    _collect_hashes(futures, wait(futures).done, hashes)
+
+    return hashes
+
+
+def index_by_hash(paths: list, hashes: dict) -> dict:
+    """
+    Returns: dict[hash] -> sorted list[str] of the paths hashed
+    """
+    idx = {}
+    for p in paths:
+        if p in hashes:
+            idx.setdefault(hashes[p], []).append(p)
     # Keep deterministic order per hash
     for k in idx:
         idx[k].sort()
     return idx
 
 
-def write_two_column_csv(csv_path: str, labelA: str, labelB: str, idxA: dict, idxB: dict):
+def build_hash_index(root: str, algo: str, cache: HashCache = None, pool: HashPool = None):
+    """
+    Returns: dict[hash] -> list[str] of absolute file paths
+    """
+    paths = list(iter_files(root))
+    return index_by_hash(paths, hash_files(paths, lambda p: content_hash(p, algo, cache), pool))
+
+
+def build_hash_indexes(rootA: str, rootB: str, algo: str, cache: HashCache = None, pool: HashPool = None):
+    """
+    Walk and hash both trees at the same time: on different devices, their files are
+    read in parallel. Files are hashed as soon as they are found.
+    Returns: (idxA, idxB), dict[hash] -> list[str] of absolute file paths
+    """
+    paths = ([], [])
+
+    def walk():
+        for side, entry in FileWalker.walk_roots([rootA, rootB]):
+            paths[side].append(entry.path)
+            yield entry.path
+
+    hashes = hash_files(walk(), lambda p: content_hash(p, algo, cache), pool)
+    return index_by_hash(paths[0], hashes), index_by_hash(paths[1], hashes)
+
+
+def size_indexes(rootA: str, rootB: str):
+    """
+    Walk both trees at the same time, the sizes come from the entries of the walk.
+    Returns: (sizesA, sizesB), dict[size] -> list[str] of absolute file paths
+    """
+    indexes = ({}, {})
+    for side, entry in FileWalker.walk_roots([rootA, rootB]):
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+        except OSError as e:
+            print(f"Warning: failed to stat {entry.path}: {e}", file=sys.stderr)
+            continue
+        indexes[side].setdefault(size, []).append(entry.path)
+    return indexes
+
+
+def build_tiered_indexes(rootA: str, rootB: str, algo: str, cache: HashCache = None, pool: HashPool = None):
+    """
+    Hash only the files which can match a file on the other side: same size,
+    then same head and tail, then same content.
+    Returns: (idxA, idxB, onlyA, onlyB) where idx are dict[hash] -> list[str] of
+    the files fully hashed and only are the files without a possible match
+    """
+    sizesA, sizesB = size_indexes(rootA, rootB)
+
+    # Step 1: a size found on one side only cannot match
+    sizes = {}
+    for size in set(sizesA) & set(sizesB):
+        for p in sizesA[size] + sizesB[size]:
+            sizes[p] = size
+
+    # Step 2: head and tail of the files of the same size, small files are hashed whole
+    partial = hash_files(list(sizes), lambda p: partial_hash(p, sizes[p], algo, cache), pool)
+
+    groupsA, groupsB = {}, {}
+    for paths, groups in ((sizesA, groupsA), (sizesB, groupsB)):
+        for size_paths in paths.values():
+            for p in size_paths:
+                if p in partial:
+                    groups.setdefault((sizes[p],) + partial[p], []).append(p)
+
+    hashes = {}
+    to_hash = []
+    for key in set(groupsA) & set(groupsB):
+        _, digest, full = key
+        if full:
+            for p in groupsA[key] + groupsB[key]:
+                hashes[p] = digest
+        else:
+            to_hash.extend(groupsA[key] + groupsB[key])
+
+    # Step 3: whole content of the files still matching
+    hashes.update(hash_files(to_hash, lambda p: content_hash(p, algo, cache), pool))
+
+    allA = [p for paths in sizesA.values() for p in paths]
+    allB = [p for paths in sizesB.values() for p in paths]
+
+    # Files which could not be read are left out, as when hashing every file
+    failed = (set(sizes) - set(partial)) | (set(to_hash) - set(hashes))
+
+    onlyA = sorted(p for p in allA if p not in hashes and p not in failed)
+    onlyB = sorted(p for p in allB if p not in hashes and p not in failed)
+
+    print(f"{len(allA) + len(allB)} files, {len(sizes)} with a size found on both sides, "
+          f"{len(to_hash)} hashed whole after their head and tail")
+
+    return index_by_hash(allA, hashes), index_by_hash(allB, hashes), onlyA, onlyB
+
+
+def write_two_column_csv(csv_path: str, labelA: str, labelB: str, idxA: dict, idxB: dict,
+                         onlyA: list = (), onlyB: list = ()):
     """
     For each content hash, pair A_paths and B_paths row-by-row.
     If counts differ, blank cells are written for the shorter side.
     Also covers unmatched hashes that exist only on one side.
+    Files not hashed, without a match (onlyA, onlyB), are written last.
     """
     with open(csv_path, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
@@ -84,15 +564,54 @@ def write_two_column_csv(csv_path: str, labelA: str, labelB: str, idxA: dict, id
             for a_path, b_path in zip_longest(a_list, b_list, fillvalue=""):
                 w.writerow([a_path, b_path])
 
+        for a_path in onlyA:
+            w.writerow([a_path, ""])
+        for b_path in onlyB:
+            w.writerow(["", b_path])
+
 
 def main():
+    global READ_STRATEGY, CHUNK_SIZE, DROP_CACHE
+
     ap = argparse.ArgumentParser(description="Compare two directories by content and emit a two-column CSV.")
-    ap.add_argument("dirA")
-    ap.add_argument("dirB")
+    ap.add_argument("dirA", nargs="?")
+    ap.add_argument("dirB", nargs="?")
     ap.add_argument("--algo", default="sha256", help="Hash algorithm (default: sha256)")
-    ap.add_argument("--csv", dest="csv_out", required=True, help="Path to write the two-column CSV report")
+    ap.add_argument("--csv", dest="csv_out", help="Path to write the two-column CSV report")
+    ap.add_argument("--tiered", action="store_true",
+                    help="Only hash files with the size of a file on the other side, head and tail first")
+    ap.add_argument("--workers", type=int,
+                    help="Hashing threads per device (default: by device type, 8 for an SSD, 1 for a spinning disk, 2 for a network mount)")
+    ap.add_argument("--read", choices=READ_STRATEGIES, default=READ_STRATEGY,
+                    help="How files are read: readinto a reused buffer, mmap, or read (default: readinto)")
+    ap.add_argument("--block-size", type=int, default=CHUNK_SIZE // 1024,
+                    help="Size in KiB of the blocks read (default: 1024)")
+    ap.add_argument("--keep-cache", action="store_true",
+                    help="Leave the files read in the page cache")
+    ap.add_argument("--cache", help="SQLite database keeping the hashes of the files for the next comparisons")
+    ap.add_argument("--prune", action="store_true",
+                    help="Remove the cache entries of files deleted or changed, then exit")
     args = ap.parse_args()
 
+    if args.block_size <= 0:
+        ap.error("--block-size must be positive")
+
+    READ_STRATEGY = args.read
+    CHUNK_SIZE = args.block_size * 1024
+    DROP_CACHE = not args.keep_cache
+
+    if args.prune:
+        if not args.cache:
+            ap.error("--prune requires --cache")
+        cache = HashCache(args.cache)
+        removed, kept = cache.prune()
+        cache.close()
+        print(f"Pruned {removed} entries from {cache.db_path}, {kept} kept")
+        return
+
+    if not args.dirA or not args.dirB or not args.csv_out:
+        ap.error("dirA, dirB and --csv are required")
+
     dirA = os.path.abspath(args.dirA)
     dirB = os.path.abspath(args.dirB)
 
@@ -100,12 +619,23 @@ def main():
         print("Both arguments must be existing directories.", file=sys.stderr)
         sys.exit(2)
 
-    print(f"Hashing A: {dirA}")
-    idxA = build_hash_index(dirA, args.algo)
-    print(f"Hashing B: {dirB}")
-    idxB = build_hash_index(dirB, args.algo)
+    cache = HashCache(args.cache) if args.cache else None
+
+    with HashPool(args.workers) as pool:
+        if args.tiered:
+            print(f"Matching A: {dirA} and B: {dirB} by size, head and tail, then content")
+            idxA, idxB, onlyA, onlyB = build_tiered_indexes(dirA, dirB, args.algo, cache, pool)
+        else:
+            print(f"Hashing A: {dirA}")
+            print(f"Hashing B: {dirB}")
+            idxA, idxB = build_hash_indexes(dirA, dirB, args.algo, cache, pool)
+            onlyA, onlyB = [], []
+
+    if cache is not None:
+        cache.close()
+        print(f"Hash cache {cache.db_path}: {cache.hits} hashes reused, {cache.misses} computed")
 
-    write_two_column_csv(args.csv_out, dirA, dirB, idxA, idxB)
+    write_two_column_csv(args.csv_out, dirA, dirB, idxA, idxB, onlyA, onlyB)
     print(f"Wrote CSV to: {args.csv_out}")
     print("Format: two columns [A_file,B_file]. Blank cell indicates no content match on that row.")
 
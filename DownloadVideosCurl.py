@@ -1,20 +1,53 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import argparse
+import asyncio
+import codecs
+import hashlib
 import json
 from urllib.parse import urlparse, urlunparse
 import shlex
 import json
 import re
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import yt_dlp
+import HttpTransport
+import HlsDownloader
+import RateLimiter
 from pathlib import Path
 
 VIDEO_PLAYLIST = '720p/video.m3u8'
 
 OUTPUT_FILE_PATTERN = "{}.mp4"
 
+# Number of videos downloaded at the same time
+JOBS = 1
+
+# Download progress of a video is printed each time this percentage is reached
+PROGRESS_STEP = 10
+
+# Downloaders of the videos: yt-dlp or the built-in HLS downloader
+BACKENDS = ('ytdlp', 'native')
+
+# Archive of the videos already downloaded, keyed by playlist item id
+ARCHIVE_FILE = "download_archive.json"
+
+# Hash of the downloaded files kept in the archive and size of the blocks read to compute it
+ARCHIVE_HASH = "sha256"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Size of the blocks of the web page read at a time
+PAGE_BLOCK_SIZE = 64 * 1024
+
+# Number of web pages downloaded at the same time
+PAGE_JOBS = 4
+
+# Lines printed by parallel jobs are printed whole
+print_lock = threading.Lock()
+
 def _parse_curl_command(text: str):
     """
     Parse a curl command from a string and return (url, headers).
@@ -74,11 +107,18 @@ def run_curl_command(curl_command: str, timeout: int = 30):
     and return the response body as a string.
     """
     url, headers = _parse_curl_command(curl_command)
-    with requests.Session() as s:
-        r = s.get(url, headers=headers, allow_redirects=True, timeout=timeout)
-        # Do not raise_for_status() to mirror curl behavior of returning body on non-2xx
-        # If the endpoint returns binary, you may want r.content instead.
-        return r.text
+    return fetch_page(url, headers, timeout)
+
+
+def fetch_page(url: str, headers: dict, timeout: int = 30):
+    """
+    GET a page with the URL and headers of a parsed curl command
+    and return the response body as a string.
+    """
+    r = HttpTransport.get(url, headers=headers, allow_redirects=True, timeout=timeout)
+    # Do not raise_for_status() to mirror curl behavior of returning body on non-2xx
+    # If the endpoint returns binary, you may want r.content instead.
+    return r.text
 
 
 def download_from_curl_with_ytdlp(curl_command: str, output_file: str, input_url: str = None):
@@ -86,108 +126,587 @@ def download_from_curl_with_ytdlp(curl_command: str, output_file: str, input_url
     Reads a curl command from a file, extracts the URL and headers,
     and downloads the media using yt-dlp with the same headers.
     """
-    tokens = shlex.split(curl_command.strip())
+    url, headers = _parse_curl_command(curl_command)
 
-    url = None
-    headers = {}
+    if input_url:
+        url = input_url  # Override URL if provided
 
-    i = 0
-    while i < len(tokens):
-        if tokens[i] == "curl":
-            url = tokens[i + 1]
-            i += 2
-        elif tokens[i] in ("-H", "--header"):
-            header_parts = tokens[i + 1].split(":", 1)
-            if len(header_parts) == 2:
-                headers[header_parts[0].strip()] = header_parts[1].strip()
-            i += 2
+    download_with_ytdlp(url, headers, output_file)
+
+
+def media_headers(headers: dict):
+    """
+    Headers of the parsed curl command without its cookies, sent with the video requests
+    with --strip-cookies. Signed CDN links do not need the cookies of the member zone,
+    which yt-dlp warns about.
+    """
+    return {k: v for k, v in headers.items() if k.lower() != "cookie"}
+
+
+def job_print(prefix: str, message: str):
+    """
+    Print each line of a message prefixed with the name of its job,
+    without mixing it with the lines of the other jobs.
+    """
+    with print_lock:
+        for line in str(message).splitlines() or [""]:
+            print(f"[{prefix}] {line}", flush=True)
+
+
+class JobLogger:
+    """
+    yt-dlp logger printing the messages of one download prefixed with its title.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def debug(self, msg):
+        # yt-dlp sends its screen messages as debug, real debug messages start with [debug]
+        if not msg.startswith("[debug] "):
+            job_print(self.prefix, msg)
+
+    def info(self, msg):
+        job_print(self.prefix, msg)
+
+    def warning(self, msg):
+        job_print(self.prefix, msg)
+
+    def error(self, msg):
+        job_print(self.prefix, msg)
+
+
+def progress_hook(prefix: str, step: int = PROGRESS_STEP):
+    """
+    Return a yt-dlp progress hook printing the progress of one download every step percent.
+    """
+    state = {'next_report': step}
+
+    def hook(status):
+        if status.get('status') == 'finished':
+            job_print(prefix, "Download finished")
+            return
+
+        if status.get('status') != 'downloading':
+            return
+
+        total = status.get('total_bytes') or status.get('total_bytes_estimate')
+
+        # HLS downloads know their number of fragments better than their size
+        if status.get('fragment_count'):
+            percent = 100 * (status.get('fragment_index') or 0) // status['fragment_count']
+        elif total:
+            percent = 100 * status.get('downloaded_bytes', 0) // total
         else:
-            i += 1
+            return
 
-    if input_url:
-        url = input_url  # Override URL if provided
-    elif not url:
-        raise ValueError("No URL found in the curl command.")
+        if percent >= state['next_report']:
+            state['next_report'] = (percent // step + 1) * step
+            job_print(prefix, f"{percent}% downloaded")
+
+    return hook
 
+
+def download_with_ytdlp(url: str, headers: dict, output_file: str, prefix: str = None, limiter=None, jobs: int = 1):
+    """
+    Download the media at url with yt-dlp using the headers of the parsed curl command.
+    When prefix is given, yt-dlp output is printed line by line prefixed with it.
+    With limiter, the download is limited to the rate of the limiter divided by jobs,
+    the number of videos downloaded at the same time. The rate is read when the
+    download starts: a new rate applies from the next video.
+    Raise yt_dlp.utils.DownloadError on failure.
+    """
     # yt-dlp options
     ydl_opts = {
         'http_headers': headers,
-        'outtmpl': output_file  # exact filename
+        'outtmpl': output_file,  # exact filename
+        'progress_hooks': [],
     }
 
+    if prefix is not None:
+        ydl_opts.update({
+            'logger': JobLogger(prefix),
+            'noprogress': True,
+        })
+        ydl_opts['progress_hooks'].append(progress_hook(prefix))
+
+    if limiter is not None:
+        limiter.check_control()
+        # yt-dlp fragment downloaders work on a copy of the options, so the rate cannot
+        # change during the download: the share is the one of a full set of jobs
+        ydl_opts['ratelimit'] = limiter.rate // max(1, jobs) or None
+
     # Run yt-dlp
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         ydl.download([url])
 
 
-def _extract_balanced(text: str, start_at: int, open_ch: str = "[", close_ch: str = "]"):
+def download_with_native(url: str, headers: dict, output_file: str, prefix: str,
+                         fragments: int = HlsDownloader.FRAGMENT_WORKERS, retries: int = HlsDownloader.FRAGMENT_RETRIES,
+                         limiter=None):
     """
-    Return the substring from the first `open_ch` after start_at up to its
-    matching `close_ch`, honoring quotes and escapes.
+    Download the HLS stream at url with the built-in downloader, fragments at a time,
+    each fragment retried up to retries times. Messages are printed prefixed with prefix.
+    With limiter, the download is one job sharing its rate.
     """
-    i = text.find(open_ch, start_at)
-    if i == -1:
-        return None
+    HlsDownloader.download_hls(url, headers, output_file, fragments, retries,
+                               report=lambda message: job_print(prefix, message), limiter=limiter)
 
-    depth = 0
-    in_str = False
-    quote = ""
-    escaped = False
 
-    for j, ch in enumerate(text[i:], start=i):
-        if in_str:
-            if escaped:
-                escaped = False
-            elif ch == "\\":
-                escaped = True
-            elif ch == quote:
-                in_str = False
-        else:
-            if ch in ("'", '"'):
-                in_str = True
-                quote = ch
-            elif ch == open_ch:
-                depth += 1
-            elif ch == close_ch:
-                depth -= 1
-                if depth == 0:
-                    return text[i:j+1]
+def file_hash(path: str) -> str:
+    """
+    Hash of the content of a file, as kept in the archive.
+    """
+    digest = hashlib.new(ARCHIVE_HASH)
+
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def archive_entry(video_title: str, video_file: str) -> dict:
+    """
+    Archive entry of a downloaded video: its file, size and content hash.
+    """
+    return {
+        'title': video_title,
+        'file': video_file,
+        'size': os.path.getsize(video_file),
+        ARCHIVE_HASH: file_hash(video_file),
+    }
+
+
+def load_archive(path: str) -> dict:
+    """
+    Read the archive of the videos already downloaded, {item id: entry}.
+    A missing or unreadable archive is empty.
+    """
+    if not os.path.exists(path):
+        return {}
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as err:
+        print(f"Ignoring archive '{path}': {err}")
+        return {}
+
+
+def save_archive(path: str, archive: dict):
+    """
+    Write the archive to a temporary file then rename it, so an interrupted run never leaves a partial archive.
+    """
+    temppath = path + ".tmp"
+
+    with open(temppath, "w", encoding="utf-8") as f:
+        json.dump(archive, f, indent=2, sort_keys=True)
+
+    os.replace(temppath, path)
+
+
+def is_archived(archive: dict, video_id: str, video_file: str) -> bool:
+    """
+    True if the video was downloaded into video_file and the file still has the archived size.
+    Only the file is checked, the content hash is checked by verify_archive.
+    """
+    entry = archive.get(video_id)
+
+    if entry is None or entry.get('file') != video_file:
+        return False
+
+    try:
+        return os.path.getsize(video_file) == entry.get('size')
+    except OSError:
+        return False
+
+
+def check_archive_entry(entry: dict):
+    """
+    Return None if the file of an archive entry is intact, else the problem found.
+    """
+    try:
+        if os.path.getsize(entry['file']) != entry.get('size'):
+            return "size changed"
+        if file_hash(entry['file']) != entry.get(ARCHIVE_HASH):
+            return "content changed"
+    except OSError as err:
+        return str(err)
+
     return None
 
+
+def verify_archive(archive: dict, jobs: int):
+    """
+    Check the files of the archive against their size and hash, jobs files at a time
+    (the --jobs of the command line).
+    Entries of missing or changed files are removed so they are downloaded again.
+    Return the list of (title, problem) removed.
+    """
+    problems = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        futures = {executor.submit(check_archive_entry, entry): video_id for video_id, entry in archive.items()}
+
+        for future in as_completed(futures):
+
+            video_id = futures[future]
+            problem = future.result()
+
+            if problem is not None:
+                problems.append((video_id, problem))
+
+    return [(archive.pop(video_id).get('title', video_id), problem) for video_id, problem in problems]
+
+
+def download_video(video_title: str, video_file: str, video_url: str, headers: dict, backend: str,
+                   fragments: int, retries: int, limiter=None, jobs: int = JOBS) -> dict:
+    """
+    Download one video with the chosen backend and return its archive entry.
+    jobs is the number of videos downloaded at the same time.
+    """
+    if backend == 'native':
+        download_with_native(video_url, headers, video_file, video_title, fragments, retries, limiter)
+    else:
+        download_with_ytdlp(video_url, headers, video_file, video_title, limiter, jobs)
+
+    return archive_entry(video_title, video_file)
+
+
+def download_videos(videos, headers: dict, jobs: int = JOBS, backend: str = 'ytdlp',
+                    fragments: int = HlsDownloader.FRAGMENT_WORKERS, retries: int = HlsDownloader.FRAGMENT_RETRIES,
+                    archive: dict = None, archive_path: str = None, limiter=None):
+    """
+    Download the (id, title, file, url) videos, jobs at a time, with the headers of the parsed curl command.
+    The native backend downloads fragments at a time for each video, retried up to retries times.
+    Each video downloaded is added to the archive, saved in archive_path when given.
+    With limiter, a RateLimiter.RateLimiter, each video gets its fair share of the rate.
+    Return the list of (title, error) of the failed videos.
+    """
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        futures = {executor.submit(download_video, video_title, video_file, video_url, headers, backend, fragments, retries,
+                                   limiter, jobs):
+                   (video_id, video_title)
+                   for video_id, video_title, video_file, video_url in videos}
+
+        for future in as_completed(futures):
+
+            video_id, video_title = futures[future]
+
+            try:
+                entry = future.result()
+                job_print(video_title, "Video successfully downloaded")
+            except Exception as err:
+                job_print(video_title, f"Download failed: {err}")
+                failures.append((video_title, str(err)))
+                continue
+
+            if archive is not None:
+                archive[video_id] = entry
+                # Saved after each video so an interrupted run keeps the videos already downloaded
+                if archive_path:
+                    save_archive(archive_path, archive)
+
+    return failures
+
+
+# Assignment of the playlist items in the inline scripts of the page
+_ITEMS_ASSIGNMENT = re.compile(r"playlist\s*\.\s*items\s*=(?!=)")
+
+# Characters kept between two chunks while looking for the assignment, longer than the assignment
+_ASSIGNMENT_TAIL = 256
+
+# Tokens of a JS literal. Strings and comments are matched whole, so the text between
+# the brackets is skipped by the regex engine instead of a loop on each character
+_JS_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*\n|/\*.*?\*/)
+  | (?P<dq>"[^"\\]*(?:\\.[^"\\]*)*")
+  | (?P<sq>'[^'\\]*(?:\\.[^'\\]*)*')
+  | (?P<tpl>`[^`\\]*(?:\\.[^`\\]*)*`)
+  | (?P<open>[\[{])
+  | (?P<close>[\]}])
+  | (?P<punct>[,:])
+  | (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<other>[^\s"'`\[\]{},:/A-Za-z_$]+|/(?![/*]))
+""", re.S | re.X)
+
+# Tokens which may continue in the next chunk, and number of characters which must follow
+# them in the chunk to be sure they are complete, as for 1.5 followed by e+3
+_OPEN_ENDED = ("space", "number", "word", "other")
+_TOKEN_LOOKAHEAD = 3
+
+# Identifiers valid as JSON values, the others are object keys
+_JSON_WORDS = ("true", "false", "null", "NaN", "Infinity")
+
+_JS_ESCAPE = re.compile(r"\\(u\{[0-9a-fA-F]+\}|u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|\r\n|[\s\S])")
+_JS_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0',
+               '\n': '', '\r': '', '\r\n': ''}
+
+
+def _js_unescape(match):
+    escape = match.group(1)
+    if escape[0] in "ux" and len(escape) > 1:
+        return chr(int(escape.strip("u{}x"), 16))
+    return _JS_ESCAPES.get(escape, escape)
+
+
+def _js_string(token: str) -> str:
+    """
+    JSON string of a JS string literal quoted with ", ' or `.
+    """
+    return json.dumps(_JS_ESCAPE.sub(_js_unescape, token[1:-1]))
+
+
+class PlaylistItemsScanner:
+    """
+    Incremental scanner of a page for the array literal assigned to `playlist.items`.
+    The page is fed in chunks as it is received and the array is converted to JSON
+    while it is scanned: single quoted and template strings, unquoted keys, undefined,
+    comments and trailing commas are accepted.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        # Assignment found, the buffer starts inside the array
+        self.in_array = False
+        self.depth = 0
+        self.pieces = []
+        self.items = None
+
+    def feed(self, text: str, final: bool = False) -> bool:
+        """
+        Scan the next chunk of the page, final for the last one.
+        Return True once the array is complete, the items are then in self.items.
+        """
+        if self.items is not None:
+            return True
+
+        self.buffer += text
+
+        if not self.in_array:
+            self._find_assignment(final)
+
+        if self.in_array:
+            self._scan_array(final)
+
+        return self.items is not None
+
+    def _find_assignment(self, final: bool):
+        match = _ITEMS_ASSIGNMENT.search(self.buffer)
+
+        while match:
+            start = len(self.buffer) - len(self.buffer[match.end():].lstrip())
+
+            if start == len(self.buffer) and not final:
+                # Value not received yet
+                self.buffer = self.buffer[match.start():]
+                return
+
+            if self.buffer.startswith("[", start):
+                self.in_array = True
+                self.buffer = self.buffer[start:]
+                return
+
+            match = _ITEMS_ASSIGNMENT.search(self.buffer, match.end())
+
+        self.buffer = self.buffer[-_ASSIGNMENT_TAIL:]
+
+    def _scan_array(self, final: bool):
+        buffer = self.buffer
+        position = 0
+
+        while True:
+            match = _JS_TOKEN.match(buffer, position)
+
+            if match is None or (len(buffer) - match.end() < _TOKEN_LOOKAHEAD and match.lastgroup in _OPEN_ENDED and not final):
+                if final:
+                    raise ValueError("playlist.items array is not complete")
+                break
+
+            kind = match.lastgroup
+            token = match.group()
+            position = match.end()
+
+            if kind in ("space", "comment"):
+                continue
+
+            if kind == "open":
+                self.depth += 1
+            elif kind == "close":
+                self.depth -= 1
+                # Trailing comma
+                if self.pieces and self.pieces[-1] == ",":
+                    self.pieces.pop()
+            elif kind == "dq":
+                if "\\" in token:
+                    token = _js_string(token)
+            elif kind in ("sq", "tpl"):
+                token = _js_string(token)
+            elif kind == "number":
+                # JS accepts .5 and 5. which JSON does not
+                if token.endswith(".") or token.lstrip("-").startswith("."):
+                    token = repr(float(token))
+            elif kind == "word":
+                if token == "undefined":
+                    token = "null"
+                elif token not in _JSON_WORDS:
+                    token = json.dumps(token)
+
+            self.pieces.append(token)
+
+            if self.depth == 0:
+                self.items = json.loads("".join(self.pieces), strict=False)
+                self.buffer = ""
+                return
+
+        self.buffer = buffer[position:]
+
+
 def extract_playlist_items(html: str):
     """
-    Extracts the JSON value assigned to `playlist.items` from a <script> block
-    in the given HTML string, and returns it as {"items": [...]}.
-  """
+    Extract the array assigned to `playlist.items` in the inline scripts of the given HTML string.
+    """
+    scanner = PlaylistItemsScanner()
 
-    # Grab all script contents quickly
-    scripts = re.findall(r"<script[^>]*>(.*?)</script>", html, flags=re.S | re.I)
+    if not scanner.feed(html, final=True):
+        raise ValueError("playlist.items not found in any <script> block.")
 
-    for script in scripts:
-        m = re.search(r"playlist\s*\.\s*items\s*=", script)
-        if not m:
-            continue
+    return scanner.items
 
-        # Extract the bracketed array assigned to playlist.items
-        arr_text = _extract_balanced(script, m.end(), "[", "]")
-        if not arr_text:
-            continue
 
-        # Try to parse as JSON (the source uses JSON-like syntax)
-        try:
-            items = json.loads(arr_text)
-            return items
-        except json.JSONDecodeError:
-            # If the source used single quotes or JS-ish tokens, do a light fix
-            fixed = arr_text
-            fixed = re.sub(r"'", '"', fixed)              # naive single→double
-            fixed = re.sub(r"\bundefined\b", "null", fixed)
-            items = json.loads(fixed)
-            return items
+def read_playlist_items(r):
+    """
+    Extract the array assigned to `playlist.items` from a streamed response while it is received.
+    The rest of the page is not read.
+    """
+    scanner = PlaylistItemsScanner()
+
+    decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")(errors="replace")
+
+    for block in r.iter_content(PAGE_BLOCK_SIZE):
+        if scanner.feed(decoder.decode(block)):
+            return scanner.items
+
+    if scanner.feed(decoder.decode(b"", final=True), final=True):
+        return scanner.items
 
     raise ValueError("playlist.items not found in any <script> block.")
 
 
+def page_cache_path(cache_dir: str, url: str) -> str:
+    """
+    File of the page cache keeping the playlist of a page.
+    """
+    return os.path.join(cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+
+def fetch_playlist_items(url: str, headers: dict, timeout: int = 30, cache_dir: str = None):
+    """
+    GET a page with the URL and headers of a parsed curl command and extract its playlist items.
+    With cache_dir, the playlist is kept with the ETag and Last-Modified of the page, which are
+    sent on the next request so an unchanged page is not downloaded again.
+    Return (items, cached), cached being True if the page was not modified.
+    """
+    entry = None
+    page_headers = dict(headers)
+
+    if cache_dir:
+        cachepath = page_cache_path(cache_dir, url)
+        try:
+            with open(cachepath, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+    if entry is not None:
+        if entry.get('etag'):
+            page_headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            page_headers['If-Modified-Since'] = entry['last_modified']
+
+    with HttpTransport.get(url, headers=page_headers, allow_redirects=True, timeout=timeout, stream=True) as r:
+
+        if r.status_code == 304 and entry is not None:
+            return entry['items'], True
+
+        if not r.ok:
+            raise IOError(f"page {url} failed to download with status code {r.status_code}")
+
+        items = read_playlist_items(r)
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+
+    # A page without validators cannot be revalidated, it is downloaded each time
+    if cache_dir and (etag or last_modified):
+        os.makedirs(cache_dir, exist_ok=True)
+        temppath = cachepath + ".tmp"
+        with open(temppath, "w", encoding="utf-8") as f:
+            json.dump({'url': url, 'etag': etag, 'last_modified': last_modified, 'items': items}, f)
+        os.replace(temppath, cachepath)
+
+    return items, False
+
+
+async def crawl_pages(urls, headers: dict, jobs: int = PAGE_JOBS, cache_dir: str = None):
+    """
+    Fetch the playlists of the pages, jobs pages at a time.
+    Return for each URL (items, cached) or the exception raised.
+    """
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def crawl(url):
+        async with semaphore:
+            # HttpTransport is blocking, each page is fetched in a thread of the default executor
+            return await asyncio.to_thread(fetch_playlist_items, url, headers, cache_dir=cache_dir)
+
+    return await asyncio.gather(*(crawl(url) for url in urls), return_exceptions=True)
+
+
+def merge_playlists(playlists):
+    """
+    Merge the playlists of several pages in order, keeping the first item of each id.
+    """
+    merged = []
+    seen = set()
+
+    for items in playlists:
+        for item in items:
+            key = item.get("id") if isinstance(item, dict) else None
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+            merged.append(item)
+
+    return merged
+
+
+def read_page_list(path: str):
+    """
+    URLs of the pages listed in a text file, one per line. Empty lines and lines starting with # are ignored.
+    """
+    urls = []
+
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                urls.append(line)
+
+    return urls
+
+
 # Replace the last segment of the path in a URL with `new_segment`
 def replace_last_path_segment(url: str, new_segment: str):
 
@@ -251,6 +770,37 @@ def main(args):
         print(f"Error reading curl file '{curl_file}: {str(err)}")
         sys.exit(-1)
 
+    # Curl command is parsed once, its headers are shared by all the downloads
+    page_url, headers = _parse_curl_command(curl_command)
+
+    try:
+        limiter = RateLimiter.RateLimiter(RateLimiter.parse_rate(args.limit_rate), args.rate_file)
+    except ValueError as err:
+        print(f"Error in download rate: {err}")
+        sys.exit(-1)
+
+    if limiter.rate or args.rate_file:
+        print(f"Download rate limited to {RateLimiter.format_rate(limiter.rate)}, shared by the {args.jobs} jobs")
+
+    archive = load_archive(args.archive)
+
+    print(f"{len(archive)} videos in archive '{args.archive}'")
+
+    if args.verify:
+        print(f"Verify the files of the archive")
+
+        problems = verify_archive(archive, args.jobs)
+
+        for video_title, problem in problems:
+            print(f"Will download again {video_title}: {problem}")
+
+        print(f"{len(archive)} videos verified, {len(problems)} removed from archive")
+
+        if problems:
+            save_archive(args.archive, archive)
+
+    failed_pages = []
+
     if args.playlist:
         inputfile = args.playlist
         #inputfile = '/mnt/c/Users/pb/Videos/Sport/Kravmaga/KravMagaGlobalEN/NewCurriculum/Checkpoints/Graduate'
@@ -267,22 +817,35 @@ def main(args):
             sys.exit(-1)
 
     else:
-        print(f"Download web page with video playlist")
+        # Without a list of pages, the page of the curl command
+        page_urls = read_page_list(args.pages) if args.pages else [page_url]
 
-        # Get the web page content using the curl command
-        webpage = run_curl_command(curl_command)
+        print(f"Download {len(page_urls)} web pages and extract video playlists")
 
-        print(f"Extract video playlist from web page")
+        # Pages are read only up to the end of their playlist, all with the headers and cookies of the curl command
+        results = asyncio.run(crawl_pages(page_urls, headers, args.page_jobs, args.page_cache))
 
-        playlist_items = extract_playlist_items(webpage)
-    
-        # Now playlist_items is a Python list/dict structure
-        print(type(playlist_items), len(playlist_items))
+        playlists = []
+
+        for url, result in zip(page_urls, results):
+            if isinstance(result, Exception):
+                print(f"Failed page {url}: {result}")
+                failed_pages.append(url)
+                continue
+
+            items, cached = result
+            print(f"{'Unchanged' if cached else 'Downloaded'} page {url}: {len(items)} videos")
+            playlists.append(items)
+
+        playlist_items = merge_playlists(playlists)
 
         nb_video = len(playlist_items)
 
         print(f"Found {nb_video} videos to download")
-        
+
+    videos = []
+    nb_archived = 0
+
     for item in playlist_items:
         if isinstance(item, dict) and item.get("title"):
 
@@ -300,17 +863,45 @@ def main(args):
             # generate video file name
             video_file = OUTPUT_FILE_PATTERN.format(video_file)
 
+            # Videos already downloaded are skipped without any request
+            if is_archived(archive, str(video_id), video_file):
+                print(f"Already downloaded {video_file}")
+                nb_archived += 1
+                continue
+
             video_url = replace_last_path_segment(playlist_url, VIDEO_PLAYLIST)
 
             print(f"Downloading {video_url}")
             
             print(f"Video filename {video_file}")
 
-            if not args.test:
-                # Execute yt-dlp and stream output live
-                download_from_curl_with_ytdlp(curl_command, video_file, video_url)
-            else:                           
-                print(f"Skipping download")
+            videos.append((str(video_id), video_title, video_file, video_url))
+
+    print(f"{len(videos)} videos to download, {nb_archived} already downloaded")
+
+    if args.test:
+        print(f"Skipping download")
+        return
+
+    # The rate file can be changed while the downloads run, and read at once with kill -USR1
+    limiter.install_signal()
+
+    # Output of the downloads is printed line by line prefixed with the video title
+    video_headers = media_headers(headers) if args.strip_cookies else headers
+
+    failures = download_videos(videos, video_headers, args.jobs, args.backend, args.fragments, args.fragment_retries,
+                               archive, args.archive, limiter)
+
+    print(f"{len(videos) - len(failures)} of {len(videos)} videos successfully downloaded")
+
+    for video_title, error in failures:
+        print(f"Failed {video_title}: {error}")
+
+    for url in failed_pages:
+        print(f"Failed page {url}")
+
+    if failures or failed_pages:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -321,6 +912,18 @@ if __name__ == "__main__":
     parser.add_argument("curl_file", help="Location of the curl command file")
     parser.add_argument("-p","--playlist", help="Json file with list of videos to download")
     parser.add_argument("-t", "--test", action='store_true', help="Just testing")
+    parser.add_argument("-j", "--jobs", type=int, default=JOBS, help="Number of videos downloaded at the same time (default 1)")
+    parser.add_argument("-b", "--backend", choices=BACKENDS, default='ytdlp', help="Downloader of the videos: yt-dlp or the built-in HLS downloader (default ytdlp)")
+    parser.add_argument("-f", "--fragments", type=int, default=HlsDownloader.FRAGMENT_WORKERS, help="Number of fragments of a video downloaded at the same time by the native backend (default 4)")
+    parser.add_argument("--limit-rate", help="Maximum download rate in bytes per second shared by all the jobs, with an optional K, M or G suffix, for example 2M (default no limit)")
+    parser.add_argument("--rate-file", help="File holding the maximum download rate, checked while downloading so it can be changed at any time")
+    parser.add_argument("--pages", help="Text file with the URLs of the pages to download, one per line, instead of the page of the curl command")
+    parser.add_argument("--page-jobs", type=int, default=PAGE_JOBS, help="Number of pages downloaded at the same time (default 4)")
+    parser.add_argument("--page-cache", help="Folder where the playlists of the pages are kept and revalidated with ETag/Last-Modified, no cache if not set")
+    parser.add_argument("-a", "--archive", default=ARCHIVE_FILE, help="Archive of the videos already downloaded, which are skipped (default download_archive.json)")
+    parser.add_argument("--verify", action='store_true', help="Check the size and hash of the archived files first, changed ones are downloaded again")
+    parser.add_argument("--strip-cookies", action='store_true', help="Do not send the cookies of the curl command with the video requests")
+    parser.add_argument("--fragment-retries", type=int, default=HlsDownloader.FRAGMENT_RETRIES, help="Number of retries of a failed fragment by the native backend (default 3)")
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -2,7 +2,7 @@
 
 import os
 from pathlib import Path, PurePath
-import glob
+import FileWalker
 import argparse
 
 
@@ -21,14 +21,12 @@ def main(args):
 	else:
 		position = '0'
 
-	globarg = sourcefolder + '/**/' + filter
-
 	if args.out_folder:
 		destinationfolder = args.out_folder
 	else:
 		destinationfolder = sourcefolder
 
-	files = glob.glob(globarg, recursive = True)
+	files = FileWalker.glob_files(sourcefolder, filter)
 
 	for file in files:
 			
@@ -0,0 +1,117 @@
+"""
+FileWalker.py
+
+Recursive listing of the files of folders, built on os.scandir, used by
+CompareFilesInFolders.py and the batch media scripts. The type of each entry comes
+from the directory listing itself, without a stat call per file, and subfolders are
+listed in parallel, which hides the latency of network mounts (SMB, NFS). Files are
+yielded as soon as their folder is listed, so they can be processed during the walk.
+
+Usage:
+  import FileWalker
+  for entry in FileWalker.walk_files("/mnt/nuc/Videos", pattern="*.mp4"):
+      print(entry.path, entry.stat().st_size)
+  for index, entry in FileWalker.walk_roots([dirA, dirB]):
+      ...
+  files = FileWalker.glob_files(sourcefolder, "*.mp4")
+
+Notes:
+- Files are yielded in no particular order, glob_files returns them sorted.
+- entry.stat() is cached by the entry: calling it once per file costs one system call
+  on Linux and none on Windows.
+- By default symbolic links are skipped and hidden files are listed. glob_files
+  behaves as glob.glob(root + '/**/' + pattern, recursive=True): it follows symbolic
+  links and skips the names starting with a dot. The pattern is matched against the
+  file name only.
+- Folders which cannot be listed are skipped, as os.walk does; onerror is called
+  with the OSError when given.
+"""
+
+import fnmatch
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Number of folders listed at the same time
+WALK_WORKERS = 8
+
+
+def _is_loop(folder: os.DirEntry, parent: str) -> bool:
+    """
+    True if the symbolic link folder points to parent or one of its ancestors.
+    """
+    target = os.path.realpath(folder.path)
+    parent = os.path.realpath(parent)
+    return parent == target or parent.startswith(target.rstrip(os.sep) + os.sep)
+
+
+def _list_folder(index: int, path: str, pattern: str, follow_links: bool, hidden: bool, onerror):
+    """
+    Files and subfolders of one folder, from the directory listing only.
+    Returns: (index, files, folders), lists of os.DirEntry
+    """
+    files, folders = [], []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not hidden and entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=follow_links):
+                        if not (follow_links and entry.is_symlink() and _is_loop(entry, path)):
+                            folders.append(entry)
+                    elif entry.is_file(follow_symlinks=follow_links):
+                        if pattern is None or fnmatch.fnmatch(entry.name, pattern):
+                            files.append(entry)
+                except OSError:
+                    continue
+    except OSError as err:
+        if onerror is not None:
+            onerror(err)
+
+    return index, files, folders
+
+
+def walk_roots(roots: list, pattern: str = None, workers: int = WALK_WORKERS,
+               follow_links: bool = False, hidden: bool = True, onerror=None):
+    """
+    Files of all the roots, whose folders are listed at the same time by workers threads.
+    Yields (index of the root in roots, os.DirEntry) for each file whose name matches pattern.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+
+        pending = {executor.submit(_list_folder, index, root, pattern, follow_links, hidden, onerror)
+                   for index, root in enumerate(roots)}
+
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, files, folders = future.result()
+                    # Subfolders are listed while the caller processes the files
+                    for folder in folders:
+                        pending.add(executor.submit(_list_folder, index, folder.path, pattern,
+                                                    follow_links, hidden, onerror))
+                    for entry in files:
+                        yield index, entry
+        finally:
+            # Caller stopped early
+            for future in pending:
+                future.cancel()
+
+
+def walk_files(root: str, pattern: str = None, workers: int = WALK_WORKERS,
+               follow_links: bool = False, hidden: bool = True, onerror=None):
+    """
+    Files of root and its subfolders whose name matches pattern, as os.DirEntry.
+    """
+    for _, entry in walk_roots([root], pattern, workers, follow_links, hidden, onerror):
+        yield entry
+
+
+def glob_files(root: str, pattern: str = "*", workers: int = WALK_WORKERS) -> list:
+    """
+    Sorted paths of the files matching pattern in root and its subfolders, as
+    glob.glob(root + '/**/' + pattern, recursive=True) without its stat calls.
+    """
+    return sorted(entry.path for entry in walk_files(root, pattern, workers, follow_links=True, hidden=False))
@@ -7,21 +7,71 @@ import logging
 import json
 import argparse
 import base64
-import requests
+import hashlib
 import csv
+import errno
+import ctypes
+import tempfile
+import queue
+import threading
+import time
 from pathlib import Path
+from collections import deque
 import subprocess
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import HttpTransport
+import Telemetry
+import SegmentCache
+import RateLimiter
 
 URL_SEPARATOR = 'playlist.json'
 VIDEOSUFFIX = ' _v'
 AUDIOSUFFIX = ' _a'
+JOURNALEXTENSION = '.journal'
 FFMPEG_BIN_PATH = 'ffmpeg'
 VIDEOEXTENSION = ".mp4"
 
 # Chosen width of selected video
 QUALITY = 1280
 
+# Number of segments downloaded to measure the throughput when a download time budget is set
+PROBE_SEGMENTS = 3
+
+# Number of segments downloaded in parallel. 1 keeps the sequential download
+SEGMENT_WORKERS = 1
+
+# Maximum number of bytes fetched by one merged range request. 0 keeps one request per segment
+COALESCE_MAX_SPAN = 0
+
+# Download progress is reported each time this percentage is reached
+PROGRESS_STEP = 10
+
+# A duplicate request is sent for a segment slower than this percentile of the recent segments. 0 disables it
+HEDGE_PERCENTILE = 95
+
+# Number of duplicate requests sent at the same time at most, on top of the segment workers
+HEDGE_WORKERS = 2
+
+# Number of recent segment download times kept, and needed before sending duplicate requests
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+# Maximum time in seconds to download one segment or one merged range
+SEGMENT_DEADLINE = 300
+
+# Size of the blocks read from a response
+READ_BLOCK_SIZE = 64 * 1024
+
+# Number of videos of a batch downloaded at the same time
+BATCH_VIDEOS = 1
+
+# Number of playlists downloaded at the same time when checking a batch
+PREFETCH_JOBS = 8
+
+# A cached playlist is used only if its link is valid for at least this number of seconds
+PLAYLIST_EXPIRY_MARGIN = 600
+
 # Disable logger in libraries
 for _ in logging.root.manager.loggerDict:
     # print(f"log {_}")
@@ -31,90 +81,1600 @@ for _ in logging.root.manager.loggerDict:
     else:
         logging.getLogger(_).setLevel(logging.INFO)
 
-logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
+
+loghandlers=[logging.StreamHandler()]
+
+#
+# Build the ffmpeg command copying video and audio streams into one video file
+#
+def mux_command(videofilepath, audiofilepath, outfilepath):
+
+    return [FFMPEG_BIN_PATH, "-y", "-loglevel", "error", "-stats", "-i", videofilepath, "-i", audiofilepath, "-c:v",  "copy", "-c:a", "copy", outfilepath]
+
+#
+# Aggregate video and audio stream into one video file
+#
+def aggregate_mediafiles(videofilein, audiofilein, videofileout):
+
+    logger.debug(f"Using ffmpeg binary located at {FFMPEG_BIN_PATH}")
+    logger.debug(f"Writing extracted audio to {videofileout}")
+
+    #Location of files. Allow to use special variable like ~ in file names
+    videofilepath = os.path.expandvars(os.path.expanduser(videofilein))
+    audiofilepath = os.path.expandvars(os.path.expanduser(audiofilein))
+    outfilepath = os.path.expandvars(os.path.expanduser(videofileout))
+
+    extract_cmd = mux_command(videofilepath, audiofilepath, outfilepath)
+     
+    try:
+        subprocess.run(extract_cmd, capture_output=False, check=True)
+        logger.debug(f"Launching command{extract_cmd}")
+
+    except subprocess.CalledProcessError as err:
+        logger.debug(f"Error aggregating video and audio streams:" + str(err))
+        return False
+
+    return True
+
+#
+# Report the combined download progress of the tracks of one video
+#
+class DownloadProgress:
+
+    def __init__(self, name, step=PROGRESS_STEP):
+        self.name = name
+        self.step = step
+        self.totals = {}
+        self.done = {}
+        self.fetched = 0
+        self.next_report = step
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add_track(self, track, total):
+        with self.lock:
+            self.totals[track] = total
+            self.done[track] = 0
+
+    # Count bytes of a track. Bytes found on disk when resuming are not counted in the rate
+    def update(self, track, nbytes, fetched=True):
+        with self.lock:
+            self.done[track] += nbytes
+
+            if fetched:
+                self.fetched += nbytes
+
+            total = sum(self.totals.values())
+            percent = 100 * sum(self.done.values()) // total if total else 100
+
+            if percent < self.next_report:
+                return
+
+            self.next_report = (percent // self.step + 1) * self.step
+
+            rate = self.fetched / max(time.monotonic() - self.start, 0.001) / (1024 * 1024)
+            tracks = ", ".join(f"{name} {100 * self.done[name] // self.totals[name] if self.totals[name] else 100}%"
+                               for name in self.totals)
+
+        logger.info(f"{self.name}: {percent}% downloaded ({tracks}) at {rate:.1f} MiB/s")
+
+#
+# Rolling distribution of the recent segment download times
+#
+class LatencyTracker:
+
+    def __init__(self, window=LATENCY_WINDOW, min_samples=LATENCY_MIN_SAMPLES):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    # Return None until enough download times are known
+    def percentile(self, percent):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+# Download times of the segments of all videos, from the same CDN
+segment_latencies = LatencyTracker()
+
+# Cache of the segments already downloaded, shared by all videos. None disables it
+segment_cache = None
+
+# Download rate shared by all the segment requests, no limit by default
+bandwidth = RateLimiter.RateLimiter()
+
+# Playlists already downloaded, by clip id, until their link expires.
+# Also saved in playlist_cache_dir when set, for the next runs
+playlist_cache = {}
+playlist_cache_lock = threading.Lock()
+playlist_cache_dir = None
+
+#
+# Number of bytes of a chunk. The ranges of the chunk URLs are inclusive and follow each other
+# while the playlist size is end - start, so the CDN sends one byte more than the playlist size
+#
+def chunk_length(chunk):
+
+    chunk_range = parse_chunk_range(chunk['url'])
+
+    if chunk_range is not None:
+        _, start, end = chunk_range
+        if chunk['size'] in (end - start, end - start + 1):
+            return end - start + 1
+
+    return chunk['size']
+
+#
+# Compute the position of each chunk in the output file from the sizes in the playlist
+#
+def chunk_offsets(firstbinarychunk, allchunks):
+
+    offsets = []
+
+    offset = len(firstbinarychunk)
+
+    for chunk in allchunks:
+        offsets.append(offset)
+        offset += chunk_length(chunk)
+
+    # Final offset is the size of the complete file
+    return offsets, offset
+
+#
+# Extract the backing resource and the byte range from a chunk URL.
+# Chunk URLs look like <base64 of range=start-end>/avf/<id>.mp4?...&range=start-end
+# Return None if the URL does not follow this pattern
+#
+def parse_chunk_range(chunk_url):
+
+    path, _, query = chunk_url.partition('?')
+
+    path_parts = path.split('/', 1)
+
+    if len(path_parts) != 2:
+        return None
+
+    byte_range = parse_qs(query).get('range')
+
+    if not byte_range:
+        return None
+
+    try:
+        start, end = (int(value) for value in byte_range[0].split('-', 1))
+    except ValueError:
+        return None
+
+    return path_parts[1], start, end
+
+#
+# Build the URL of a range of the backing resource from the URL of one of its chunks
+#
+def merged_chunk_url(chunk_url, start, end):
+
+    path, _, query = chunk_url.partition('?')
+
+    byte_range = f"{start}-{end}"
+
+    # The first path element is the base64 encoded range without padding
+    range_token = base64.urlsafe_b64encode(f"range={byte_range}".encode("ascii")).decode("ascii").rstrip('=')
+
+    resource = path.split('/', 1)[1]
+
+    query_parts = [f"range={byte_range}" if part.startswith("range=") else part for part in query.split('&')]
+
+    return range_token + '/' + resource + '?' + '&'.join(query_parts)
+
+#
+# Group chunks into runs of contiguous byte ranges on the same backing resource.
+# Each run spans at most max_span bytes. max_span of 0 disables the grouping.
+# Only the chunks listed in indices are planned when given
+#
+def plan_chunk_runs(allchunks, max_span=COALESCE_MAX_SPAN, indices=None):
+
+    if indices is None:
+        indices = range(len(allchunks))
+
+    runs = []
+
+    run = []
+    run_resource = None
+    run_end = None
+    run_span = 0
+
+    for index_chunk in indices:
+
+        chunk = allchunks[index_chunk]
+
+        chunk_range = parse_chunk_range(chunk['url']) if max_span > 0 else None
+
+        if chunk_range is not None:
+            resource, start, end = chunk_range
+            # Range must be consistent with the size announced in the playlist
+            if chunk['size'] not in (end - start, end - start + 1):
+                chunk_range = None
+
+        if (chunk_range is not None and run and resource == run_resource
+                and start == run_end + 1 and run_span + chunk_length(chunk) <= max_span):
+            run.append(index_chunk)
+            run_end = end
+            run_span += chunk_length(chunk)
+            continue
+
+        if run:
+            runs.append(run)
+
+        run = [index_chunk]
+
+        if chunk_range is not None:
+            run_resource = resource
+            run_end = end
+            run_span = chunk_length(chunk)
+        else:
+            # Chunk cannot be merged with the next one
+            run_resource = None
+
+    if run:
+        runs.append(run)
+
+    return runs
+
+#
+# Writer of downloaded chunks at their offset in an output file.
+# Writes come from several workers at the same time
+#
+class FileChunkWriter:
+
+    def __init__(self, outfile, offsets, telemetry=None):
+        self.outfile = outfile
+        self.offsets = offsets
+        self.telemetry = telemetry
+        self.lock = threading.Lock()
+
+    def write(self, index_chunk, position, data):
+
+        if self.telemetry is None:
+            self.write_at(index_chunk, position, data)
+            return
+
+        start = time.perf_counter()
+        self.write_at(index_chunk, position, data)
+        self.telemetry.record("file_write", time.perf_counter() - start, len(data))
+
+    def write_at(self, index_chunk, position, data):
+
+        offset = self.offsets[index_chunk] + position
+
+        if hasattr(os, "pwrite"):
+            fd = self.outfile.fileno()
+            while data:
+                written = os.pwrite(fd, data, offset)
+                data = data[written:]
+                offset += written
+        else:
+            with self.lock:
+                self.outfile.seek(offset)
+                self.outfile.write(data)
+
+
+#
+# Writer of downloaded chunks in memory, until they can be written in order
+#
+class MemoryChunkWriter:
+
+    def __init__(self, allchunks):
+        self.allchunks = allchunks
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def write(self, index_chunk, position, data):
+
+        with self.lock:
+            if index_chunk not in self.buffers:
+                self.buffers[index_chunk] = bytearray(chunk_length(self.allchunks[index_chunk]))
+            buffer = self.buffers[index_chunk]
+
+        buffer[position:position + len(data)] = data
+
+    # Return the chunk data and release it
+    def pop(self, index_chunk):
+
+        with self.lock:
+            return self.buffers.pop(index_chunk)
+
+#
+# Writer of downloaded chunks through another writer, keeping a copy in memory so
+# they are stored in the segment cache by the worker without being read back
+#
+class CachingChunkWriter:
+
+    def __init__(self, writer, allchunks):
+        self.writer = writer
+        self.copies = MemoryChunkWriter(allchunks)
+
+    def write(self, index_chunk, position, data):
+        self.writer.write(index_chunk, position, data)
+        self.copies.write(index_chunk, position, data)
+
+    # Store the copy of the chunks in the segment cache and release it
+    def store(self, indices, allchunks):
+
+        for index_chunk in indices:
+            cache_chunk(index_chunk, allchunks[index_chunk], self.copies.pop(index_chunk))
+
+#
+# Cancel a running request. Once cancelled, the request does not write any more data
+# and its response is closed, freeing its connection
+#
+class FetchCancel:
+
+    def __init__(self):
+        self.cancelled = False
+        self.response = None
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            response = self.response
+
+        if response is not None:
+            # A read blocked on the response fails, the request returns
+            try:
+                response.close()
+            except Exception as err:
+                logger.debug(f"Error closing cancelled request: {err}")
+
+#
+# Deadline of a request, shared by its attempts and by the caller waiting for them.
+# Time waiting for the rate limit pushes it back
+#
+class FetchDeadline:
+
+    def __init__(self, seconds):
+        self.time = time.monotonic() + seconds
+        self.lock = threading.Lock()
+
+    def extend(self, seconds):
+        with self.lock:
+            self.time += seconds
+
+    def remaining(self):
+        with self.lock:
+            return self.time - time.monotonic()
+
+# Read buffers reused by the requests
+read_buffers = queue.SimpleQueue()
+
+# Workers sending the duplicate requests of slow segments
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+#
+# GET a URL and pass its body to sink(position, data) block by block, reading into a reused buffer.
+# Raise TimeoutError once the deadline, a FetchDeadline, is passed. The body is read within the rate limit,
+# at the fair share of job when given.
+# Return (status code, number of bytes). Number of bytes is None if the answer is an error or if cancel is set
+#
+def fetch_body(url, hds, deadline, cancel, sink, job=None):
+
+    remaining = deadline.remaining()
+
+    timeout = (HttpTransport.settings['connect_timeout'], max(0.1, min(HttpTransport.settings['read_timeout'], remaining)))
+
+    with HttpTransport.get(url, headers=hds, stream=True, timeout=timeout) as resp:
+
+        if not resp.ok:
+            return resp.status_code, None
+
+        with cancel.lock:
+            if cancel.cancelled:
+                return resp.status_code, None
+            cancel.response = resp
+
+        # Decode the body if the server compressed it
+        resp.raw.decode_content = True
+
+        try:
+            buffer = read_buffers.get_nowait()
+        except queue.Empty:
+            buffer = bytearray(READ_BLOCK_SIZE)
+
+        view = memoryview(buffer)
+
+        position = 0
+
+        try:
+            while True:
+
+                nbytes = resp.raw.readinto(view)
+
+                if not nbytes:
+                    return resp.status_code, position
+
+                if deadline.remaining() < 0:
+                    raise TimeoutError(f"not downloaded within {SEGMENT_DEADLINE} seconds")
+
+                # An abandoned request must not take the rate of the next attempt
+                if cancel.cancelled:
+                    return resp.status_code, None
+
+                # Time waiting for the rate limit does not count in the deadline
+                throttle_start = time.monotonic()
+                (job if job is not None else bandwidth).consume(nbytes)
+                deadline.extend(time.monotonic() - throttle_start)
+
+                with cancel.lock:
+                    if cancel.cancelled:
+                        return resp.status_code, None
+
+                    sink(position, view[:nbytes])
+
+                position += nbytes
+
+        finally:
+            view.release()
+            read_buffers.put(buffer)
+
+#
+# Send the duplicate request of a slow segment if the first request has not finished at start_time.
+# The first answer with a body wins and cancels the first request.
+# Return (status code, number of bytes) like fetch_body, None if the first request finished before
+#
+def fetch_hedge(url, hds, deadline, sink, job, start_time, first_done, first_cancel, cancel):
+
+    if first_done.wait(max(0, start_time - time.monotonic())):
+        return None
+
+    logger.debug(f"Request slower than the recent segments, sending a duplicate request")
+
+    result = fetch_body(url, hds, deadline, cancel, sink, job)
+
+    if result[1] is not None:
+        first_cancel.cancel()
+
+    return result
+
+#
+# GET a URL within SEGMENT_DEADLINE seconds and pass its body to sink. The request runs on the calling thread.
+# With hedge set, if the request takes longer than HEDGE_PERCENTILE of the recent segments, a duplicate
+# request is sent by one of the HEDGE_WORKERS and the first answer is kept.
+# Both requests write the same data at the same position. Return (status code, number of bytes) like fetch_body
+#
+def fetch_with_deadline(url, hds, sink, hedge=True, job=None):
+
+    start = time.monotonic()
+
+    deadline = FetchDeadline(SEGMENT_DEADLINE)
+
+    # Under a rate limit, a duplicate request would only share the same bandwidth
+    threshold = segment_latencies.percentile(HEDGE_PERCENTILE) if hedge and HEDGE_PERCENTILE > 0 and not bandwidth.rate else None
+
+    cancel = FetchCancel()
+
+    hedged = None
+
+    if threshold is not None:
+        first_done = threading.Event()
+        hedge_cancel = FetchCancel()
+        hedged = hedge_executor.submit(fetch_hedge, url, hds, deadline, sink, job, start + threshold,
+                                       first_done, cancel, hedge_cancel)
+
+    result = None
+    error = None
+
+    try:
+        result = fetch_body(url, hds, deadline, cancel, sink, job)
+    except Exception as err:
+        error = err
+
+    if hedged is not None:
+
+        first_done.set()
+
+        if result is not None and result[1] is not None:
+            # Stop the duplicate request, it does not write anything after that
+            hedged.cancel()
+            hedge_cancel.cancel()
+
+        # The duplicate request won and stopped the first one, or the first one failed
+        elif not hedged.cancel():
+            try:
+                answer = hedged.result()
+            except Exception as err:
+                error = err
+            else:
+                if answer is not None and (result is None or answer[1] is not None):
+                    result = answer
+
+    if result is None:
+        raise error if error is not None else TimeoutError(f"not downloaded within {SEGMENT_DEADLINE} seconds")
+
+    if hedge and result[1] is not None:
+        segment_latencies.add(time.monotonic() - start)
+
+    return result
+
+#
+# Download one binary media chunk into the writer. Return False on error
+#
+def fetch_chunk(index_chunk, chunk, baseurl, hds, writer, telemetry=None, job=None):
+
+    url = baseurl + chunk['url']
+    logger.debug(f"Chunk {index_chunk} URL {url}")
+
+    size = chunk_length(chunk)
+
+    # Never write past the chunk, the next one may already be there
+    def sink(position, data):
+        if position + len(data) > size:
+            raise ValueError(f"more than {size} bytes received")
+        writer.write(index_chunk, position, data)
+
+    start = time.perf_counter()
+
+    try:
+        status, nbytes = fetch_with_deadline(url, hds, sink, job=job)
+    except Exception as err:
+        logger.error(f"Chunk {index_chunk} failed to download: {err}")
+        logger.error(f"Chunk {index_chunk} URL {url}")
+        return False
+
+    if nbytes is None:
+        logger.error(f"Chunk {index_chunk} failed to download with status code: {status}")
+        logger.error(f"Chunk {index_chunk} URL {url}")
+        return False
+
+    # Each chunk is written at an offset computed from the playlist so the size must match
+    if nbytes != size:
+        logger.error(f"Chunk {index_chunk} has {nbytes} bytes, expected {size}")
+        return False
+
+    if telemetry is not None:
+        telemetry.record("segment_fetch", time.perf_counter() - start, nbytes)
+
+    logger.debug(f"Chunk {index_chunk} was successfully downloaded")
+
+    return True
+
+#
+# Download a run of contiguous chunks with one range request into the writer. Return False on error.
+# Fall back to one request per chunk if the CDN rejects the merged range
+#
+def download_run(run, allchunks, baseurl, hds, merge_state, writer, telemetry=None, job=None):
+
+    if len(run) > 1 and merge_state['enabled']:
+
+        first_url = allchunks[run[0]]['url']
+        _, start, _ = parse_chunk_range(first_url)
+        _, last_start, end = parse_chunk_range(allchunks[run[-1]]['url'])
+
+        url = baseurl + merged_chunk_url(first_url, start, end)
+        logger.debug(f"Chunks {run[0]} to {run[-1]} merged URL {url}")
+
+        # Each chunk is found at the position of its own range in the merged range
+        layout = [(index_chunk, parse_chunk_range(allchunks[index_chunk]['url'])[1] - start, chunk_length(allchunks[index_chunk]))
+                  for index_chunk in run]
+
+        def sink(position, data):
+            end_position = position + len(data)
+            for index_chunk, chunk_position, size in layout:
+                low = max(position, chunk_position)
+                high = min(end_position, chunk_position + size)
+                if low < high:
+                    writer.write(index_chunk, low - chunk_position, data[low - position:high - position])
+
+        fetch_start = time.perf_counter()
+
+        try:
+            _, nbytes = fetch_with_deadline(url, hds, sink, hedge=False, job=job)
+        except Exception as err:
+            logger.debug(f"Merged range request failed: {err}")
+            nbytes = None
+
+        # Server must count the range the same way as for a single chunk
+        if nbytes is not None and nbytes == last_start - start + chunk_length(allchunks[run[-1]]):
+
+            if telemetry is not None:
+                telemetry.record("segment_fetch", time.perf_counter() - fetch_start, nbytes)
+
+            logger.debug(f"Chunks {run[0]} to {run[-1]} were successfully downloaded")
+
+            return True
+
+        # Do not try again merged ranges for the remaining runs of this stream
+        merge_state['enabled'] = False
+        logger.warning(f"Merged range {start}-{end} rejected by the server, using one request per chunk")
+
+    for index_chunk in run:
+
+        if not fetch_chunk(index_chunk, allchunks[index_chunk], baseurl, hds, writer, telemetry, job):
+            return False
+
+    return True
+
+#
+# Download a run of chunks into the writer and add them to the segment cache. Return False on error
+#
+def fetch_run(run, allchunks, baseurl, hds, merge_state, writer, telemetry=None, job=None):
+
+    if segment_cache is None:
+        return download_run(run, allchunks, baseurl, hds, merge_state, writer, telemetry, job)
+
+    caching = CachingChunkWriter(writer, allchunks)
+
+    if not download_run(run, allchunks, baseurl, hds, merge_state, caching, telemetry, job):
+        return False
+
+    caching.store(run, allchunks)
+
+    return True
+
+#
+# Copy the chunks of a run found in the segment cache into the writer and download the other ones.
+# Used when streaming, as cached chunks cannot be written before the chunks downloaded ahead of them.
+# Return False on error
+#
+def fetch_cached_run(run, allchunks, baseurl, hds, merge_state, writer, telemetry=None, job=None):
+
+    missing = [index_chunk for index_chunk in run if not read_cached_chunk(writer, allchunks, index_chunk, telemetry)]
+
+    if missing == run:
+        return fetch_run(run, allchunks, baseurl, hds, merge_state, writer, telemetry, job)
+
+    # Chunks left are no longer contiguous
+    return all(fetch_run([index_chunk], allchunks, baseurl, hds, merge_state, writer, telemetry, job)
+               for index_chunk in missing)
+
+#
+# Identify the stream written in a file from its initial chunk and the size of its chunks
+#
+def journal_fingerprint(firstbinarychunk, allchunks):
+
+    digest = hashlib.sha1(firstbinarychunk)
+
+    for chunk in allchunks:
+        digest.update(f"{chunk['size']},".encode("ascii"))
+
+    return digest.hexdigest()
+
+#
+# Read the journal of a partially downloaded file.
+# Return the set of chunks already written and verified, empty if the file must be downloaded again
+#
+def read_journal(journalpath, outfilepath, fingerprint, nb_chunks, file_size):
+
+    if not os.path.exists(journalpath) or not os.path.exists(outfilepath):
+        return set()
+
+    if os.path.getsize(outfilepath) != file_size:
+        return set()
+
+    done = set()
+
+    try:
+        with open(journalpath, "r", encoding="utf-8") as journal:
+
+            header = json.loads(journal.readline())
+
+            if header.get('fingerprint') != fingerprint or header.get('chunks') != nb_chunks:
+                logger.info(f"Journal {journalpath} is for another stream, download again")
+                return set()
+
+            for line in journal:
+                # Last line may be incomplete if the previous run was interrupted
+                if line.strip().isdigit() and int(line) < nb_chunks:
+                    done.add(int(line))
+
+    except (json.JSONDecodeError, AttributeError, OSError) as err:
+        logger.warning(f"Cannot read journal {journalpath}: {err}")
+        return set()
+
+    return done
+
+#
+# Record in the journal the chunks of a run written in the file
+#
+def record_run(journal, run, allchunks, progress=None, track=None):
+
+    for index_chunk in run:
+
+        journal.write(f"{index_chunk}\n")
+
+        logger.debug(f"Write segment {index_chunk} in binary file")
+
+        if progress is not None:
+            progress.update(track, chunk_length(allchunks[index_chunk]))
+
+    journal.flush()
+
+#
+# Copy a chunk found in the segment cache into the writer. Return False if the cache does not have it
+#
+def read_cached_chunk(writer, allchunks, index_chunk, telemetry=None):
+
+    if segment_cache is None:
+        return False
+
+    key = parse_chunk_range(allchunks[index_chunk]['url'])
+
+    if key is None:
+        return False
+
+    start = time.perf_counter()
+
+    data = segment_cache.get(*key)
+
+    # A segment of another size is not the same segment
+    if data is None or len(data) != chunk_length(allchunks[index_chunk]):
+        return False
+
+    writer.write(index_chunk, 0, data)
+
+    if telemetry is not None:
+        telemetry.record("cache_read", time.perf_counter() - start, len(data))
+
+    return True
+
+#
+# Copy the chunks found in the segment cache into the writer and record them in the journal.
+# Return the set of chunks copied
+#
+def copy_cached_chunks(writer, journal, allchunks, indices, progress=None, track=None, telemetry=None):
+
+    copied = [index_chunk for index_chunk in indices if read_cached_chunk(writer, allchunks, index_chunk, telemetry)]
+
+    if copied:
+        record_run(journal, copied, allchunks)
+
+        if progress is not None:
+            progress.update(track, sum(chunk_length(allchunks[index_chunk]) for index_chunk in copied), fetched=False)
+
+    return set(copied)
+
+#
+# Write the chunks already downloaded to measure the throughput, by index in probes, and record them in the journal.
+# They are added to the segment cache. Return the set of chunks written
+#
+def write_probe_chunks(writer, journal, allchunks, indices, probes, progress=None, track=None):
+
+    written = [index_chunk for index_chunk in indices if index_chunk in probes]
+
+    for index_chunk in written:
+        writer.write(index_chunk, 0, probes[index_chunk])
+        cache_chunk(index_chunk, allchunks[index_chunk], probes[index_chunk])
+
+    if written:
+        record_run(journal, written, allchunks)
+
+        if progress is not None:
+            progress.update(track, sum(chunk_length(allchunks[index_chunk]) for index_chunk in written), fetched=False)
+
+    return set(written)
+
+#
+# Store the data of a downloaded chunk in the segment cache
+#
+def cache_chunk(index_chunk, chunk, data):
+
+    if segment_cache is None:
+        return
+
+    key = parse_chunk_range(chunk['url'])
+
+    if key is None:
+        return
+
+    try:
+        segment_cache.put(*key, data)
+    except OSError as err:
+        logger.warning(f"Cannot store chunk {index_chunk} in segment cache: {err}")
+
+#
+# Download the chunks from first to the last one after the other, each one written right after the previous one
+# with the length sent by the CDN, as the sequential download always did. Chunks are journaled and cached only
+# while they are at the offset computed from the playlist. Return False on error
+#
+def write_chunks_sequential(outfile, journal, allchunks, first, offsets, baseurl, hds, progress=None, track=None,
+                            telemetry=None, job=None):
+
+    # Offsets of the chunks where they are actually written
+    writer = FileChunkWriter(outfile, list(offsets), telemetry)
+
+    position = offsets[first]
+
+    for index_chunk in range(first, len(allchunks)):
+
+        chunk = allchunks[index_chunk]
+        size = chunk_length(chunk)
+
+        writer.offsets[index_chunk] = position
+
+        # Downloaded chunks are kept in memory for the segment cache
+        caching = None
+
+        if read_cached_chunk(writer, allchunks, index_chunk, telemetry):
+
+            nbytes = size
+
+        else:
+            url = baseurl + chunk['url']
+            logger.debug(f"Chunk {index_chunk} URL {url}")
+
+            if segment_cache is not None:
+                caching = CachingChunkWriter(writer, allchunks)
+
+            start = time.perf_counter()
+
+            try:
+                status, nbytes = fetch_with_deadline(url, hds, lambda offset, data, index_chunk=index_chunk, target=caching or writer:
+                                                     target.write(index_chunk, offset, data), job=job)
+            except Exception as err:
+                logger.error(f"Chunk {index_chunk} failed to download: {err}")
+                logger.error(f"Chunk {index_chunk} URL {url}")
+                return False
+
+            if nbytes is None:
+                logger.error(f"Chunk {index_chunk} failed to download with status code: {status}")
+                logger.error(f"Chunk {index_chunk} URL {url}")
+                return False
+
+            if telemetry is not None:
+                telemetry.record("segment_fetch", time.perf_counter() - start, nbytes)
+
+            if nbytes != size:
+                logger.warning(f"Chunk {index_chunk} has {nbytes} bytes, expected {size}: written as received")
+
+        # The next chunks are no longer at their playlist offset, a resume downloads them again
+        if position == offsets[index_chunk] and nbytes == size:
+            if caching is not None:
+                caching.store([index_chunk], allchunks)
+            record_run(journal, [index_chunk], allchunks, progress, track)
+        elif progress is not None:
+            progress.update(track, size)
+
+        position += nbytes
+
+    # File was preallocated with the sizes of the playlist
+    outfile.truncate(position)
+
+    return True
+
+#
+# Download runs of binary media chunks with the executor workers, each chunk written at its offset in the file.
+# At most window runs are queued at a time so tracks sharing the same executor are downloaded together
+#
+def write_runs_concurrent(writer, journal, allchunks, runs, baseurl, hds, executor, window, progress=None, track=None,
+                          telemetry=None, job=None):
+
+    merge_state = {'enabled': True}
+
+    remaining_runs = iter(runs)
+
+    futures = {}
+
+    failed = False
+
+    while True:
+
+        if not failed:
+            for run in remaining_runs:
+                futures[executor.submit(fetch_run, run, allchunks, baseurl, hds, merge_state, writer, telemetry, job)] = run
+                if len(futures) >= window:
+                    break
+
+        if not futures:
+            break
+
+        finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+
+        # Every run downloaded is journaled, even after a failure, so a resume does not download it again
+        for future in finished:
+
+            run = futures.pop(future)
+
+            if future.cancelled() or not future.result():
+                if not failed:
+                    failed = True
+                    # Do not start the runs still waiting in the queue, wait for the running ones
+                    for pending in futures:
+                        pending.cancel()
+                continue
+
+            record_run(journal, run, allchunks, progress, track)
+
+    return not failed
+
+#
+# Download and assemble binary media chunks into one file.
+# A journal next to the file records the chunks already written so an interrupted download can be resumed.
+# Chunks found in the segment cache are copied from it, the downloaded ones are added to it.
+# probes holds by index the chunks already downloaded to measure the throughput.
+# Chunks are downloaded with the workers of executor when given, to share them with other tracks
+#
+def write_chunks(outfilepath, firstbinarychunk, allchunks, baseurl, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN,
+                 executor=None, progress=None, track=None, telemetry=None, job=None, probes=None):
+
+    nb_chunks = len(allchunks)
+
+    offsets, file_size = chunk_offsets(firstbinarychunk, allchunks)
+
+    journalpath = outfilepath + JOURNALEXTENSION
+
+    fingerprint = journal_fingerprint(firstbinarychunk, allchunks)
+
+    done = read_journal(journalpath, outfilepath, fingerprint, nb_chunks, file_size)
+
+    missing = [index_chunk for index_chunk in range(nb_chunks) if index_chunk not in done]
+
+    if done:
+        logger.info(f"Resuming {outfilepath}: {len(done)} of {nb_chunks} chunks already downloaded")
+
+    if progress is not None:
+        progress.update(track, len(firstbinarychunk) + sum(chunk_length(allchunks[index_chunk]) for index_chunk in done), fetched=False)
+
+    # Write the binary data to an MP4 file. Chunks are written by the workers without buffering
+    with open(outfilepath, "r+b" if done else "w+b", buffering=0) as outfile, \
+         open(journalpath, "a" if done else "w", encoding="utf-8") as journal:
+
+        if not done:
+
+            journal.write(json.dumps({'fingerprint': fingerprint, 'chunks': nb_chunks, 'size': file_size}) + "\n")
+
+            logger.debug(f"Write initial chunk")
+
+            outfile.write(firstbinarychunk)
+
+            # Preallocate the file so chunks can be written in any order without fragmenting it
+            preallocate(outfile, file_size)
+
+        writer = FileChunkWriter(outfile, offsets, telemetry)
+
+        if probes:
+            probed = write_probe_chunks(writer, journal, allchunks, missing, probes, progress, track)
+            missing = [index_chunk for index_chunk in missing if index_chunk not in probed]
+
+        # Downloaded one at a time to the end, chunks are written with the length sent by the CDN
+        if executor is None and workers <= 1 and not max_span and missing and missing == list(range(missing[0], nb_chunks)):
+
+            try:
+                if not write_chunks_sequential(outfile, journal, allchunks, missing[0], offsets, baseurl, hds,
+                                               progress, track, telemetry, job):
+                    return False
+
+            except Exception as err:
+                # log error
+                logger.error("Error reading chunks :" + str(err))
+                return False
+
+            logger.debug(f"Ouput file {outfilepath} ready")
+
+            return True
+
+        if segment_cache is not None:
+
+            cached = copy_cached_chunks(writer, journal, allchunks, missing, progress, track, telemetry)
+
+            if cached:
+                logger.info(f"{len(cached)} of {len(missing)} chunks of {outfilepath} found in segment cache")
+                missing = [index_chunk for index_chunk in missing if index_chunk not in cached]
+
+        runs = plan_chunk_runs(allchunks, max_span, missing)
+
+        logger.debug(f"Found {len(missing)} chunks to download in {len(runs)} requests")
+
+        try:
+            if executor is not None:
+                if not write_runs_concurrent(writer, journal, allchunks, runs, baseurl, hds,
+                                             executor, 2 * workers, progress, track, telemetry, job):
+                    return False
+
+            elif workers > 1:
+                logger.debug(f"Downloading with {workers} workers")
+
+                with ThreadPoolExecutor(max_workers=workers) as own_executor:
+                    result = write_runs_concurrent(writer, journal, allchunks, runs, baseurl, hds,
+                                                   own_executor, 2 * workers, progress, track, telemetry, job)
+                if not result:
+                    return False
+
+            else:
+                merge_state = {'enabled': True}
+
+                # start reading each run of chunks
+                for run in runs:
+
+                    if not fetch_run(run, allchunks, baseurl, hds, merge_state, writer, telemetry, job):
+                        return False
+
+                    record_run(journal, run, allchunks, progress, track)
+
+        except Exception as err:
+            # log error
+            logger.error("Error reading chunks :" + str(err))
+            return False
+
+    logger.debug(f"Ouput file {outfilepath} ready")
+
+    return True
+
+#
+# fallocate function of the C library, None where there is none (Windows, macOS).
+# os.posix_fallocate is not used: on filesystems without fallocate (9p, WSL /mnt/c)
+# glibc emulates it by writing one byte in each block of the file
+#
+def load_fallocate():
+
+    try:
+        function = ctypes.CDLL(None, use_errno=True).fallocate64
+    except (OSError, TypeError, AttributeError):
+        return None
+
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    function.restype = ctypes.c_int
+
+    return function
+
+native_fallocate = load_fallocate()
+
+#
+# Reserve the disk space of the complete file where the filesystem supports it,
+# otherwise only set its size
+#
+def preallocate(outfile, file_size):
+
+    if native_fallocate is not None:
+        if native_fallocate(outfile.fileno(), 0, 0, file_size) == 0:
+            return
+        logger.debug(f"Cannot preallocate file: {os.strerror(ctypes.get_errno())}")
+
+    outfile.truncate(file_size)
+
+#
+# Download runs of binary media chunks with the executor workers and write them in order into a pipe.
+# Only the runs within window of the one being written are downloaded ahead.
+# Chunks found in the segment cache are read from it by the workers, the downloaded ones are added to it.
+# Chunks already downloaded to measure the throughput, by index in probes, are written without a request
+#
+def stream_chunks(pipe, firstbinarychunk, allchunks, baseurl, hds, executor, window, max_span=COALESCE_MAX_SPAN,
+                  progress=None, track=None, telemetry=None, job=None, probes=None):
+
+    if probes is None:
+        probes = {}
+
+    runs = plan_chunk_runs(allchunks, max_span, [index_chunk for index_chunk in range(len(allchunks)) if index_chunk not in probes])
+
+    merge_state = {'enabled': True}
+
+    writer = MemoryChunkWriter(allchunks)
+
+    pipe.write(firstbinarychunk)
+
+    if progress is not None:
+        progress.update(track, len(firstbinarychunk))
+
+    def write_chunk(index_chunk, data):
+
+        # Time blocked on the pipe is time ffmpeg is not reading
+        start = time.perf_counter()
+
+        pipe.write(data)
+
+        if telemetry is not None:
+            telemetry.record("pipe_write", time.perf_counter() - start, len(data))
+
+        logger.debug(f"Write segment {index_chunk} in pipe")
+
+        if progress is not None:
+            progress.update(track, chunk_length(allchunks[index_chunk]))
+
+    futures = {}
+
+    next_run = 0
+
+    # Next chunk to write into the pipe
+    next_chunk = 0
+
+    for index_run in range(len(runs)):
+
+        while next_run < len(runs) and next_run < index_run + window:
+            futures[next_run] = executor.submit(fetch_cached_run, runs[next_run], allchunks, baseurl, hds, merge_state, writer,
+                                                telemetry, job)
+            next_run += 1
+
+        for index_chunk in range(next_chunk, runs[index_run][0]):
+            write_chunk(index_chunk, probes[index_chunk])
+
+        if not futures.pop(index_run).result():
+            # Do not start the runs still waiting in the queue
+            for pending in futures.values():
+                pending.cancel()
+            return False
+
+        for index_chunk in runs[index_run]:
+            write_chunk(index_chunk, writer.pop(index_chunk))
+
+        next_chunk = runs[index_run][-1] + 1
+
+    for index_chunk in range(next_chunk, len(allchunks)):
+        write_chunk(index_chunk, probes[index_chunk])
+
+    return True
+
+#
+# Open a named pipe for writing once the ffmpeg process reads it. Return None if ffmpeg exits before
+#
+def open_fifo_writer(fifopath, mux_process):
+
+    while True:
+        try:
+            fd = os.open(fifopath, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as err:
+            # No reader yet on the pipe
+            if err.errno != errno.ENXIO:
+                raise
+        else:
+            os.set_blocking(fd, True)
+            return os.fdopen(fd, "wb")
+
+        if mux_process.poll() is not None:
+            return None
+
+        time.sleep(0.05)
+
+#
+# Download the chunks of one track into the named pipe read by ffmpeg
+#
+def stream_track(fifopath, firstbinarychunk, allchunks, baseurl, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN,
+                 executor=None, progress=None, track=None, mux_process=None, telemetry=None, job=None, probes=None):
+
+    try:
+        pipe = open_fifo_writer(fifopath, mux_process)
+
+        if pipe is None:
+            logger.error(f"ffmpeg stopped before reading {track} stream")
+            return False
+
+        with pipe:
+            return stream_chunks(pipe, firstbinarychunk, allchunks, baseurl, hds, executor, 2 * workers,
+                                 max_span, progress, track, telemetry, job, probes)
+
+    except Exception as err:
+        # log error
+        logger.error(f"Error streaming {track} chunks: " + str(err))
+        return False
+
+#
+# Download the tracks of a video at the same time. Each track is a tuple
+# (name, file path, initial chunk, chunks, chunk base URL). The chunks of all tracks share the same workers.
+# When mux_process is given, file paths are named pipes read by this ffmpeg process.
+# When executor is given, its workers are used instead of a pool of workers for this video only.
+# probes holds by track the chunks already downloaded, by chunk index
+#
+def download_tracks(name, tracks, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN, mux_process=None, executor=None,
+                    telemetry=None, job=None, probes=None):
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=workers) as own_executor:
+            return download_tracks(name, tracks, hds, workers, max_span, mux_process, own_executor, telemetry, job, probes)
+
+    if probes is None:
+        probes = {}
+
+    progress = DownloadProgress(name)
+
+    for track, filepath, init_binary, all_chunks, chunk_base_url in tracks:
+        progress.add_track(track, chunk_offsets(init_binary, all_chunks)[1])
+
+    result = True
+
+    with ThreadPoolExecutor(max_workers=len(tracks)) as pipelines:
+
+        if mux_process is None:
+            futures = {pipelines.submit(write_chunks, filepath, init_binary, all_chunks, chunk_base_url, hds,
+                                        workers, max_span, executor, progress, track, telemetry, job,
+                                        probes.get(track)): (track, filepath)
+                       for track, filepath, init_binary, all_chunks, chunk_base_url in tracks}
+        else:
+            futures = {pipelines.submit(stream_track, filepath, init_binary, all_chunks, chunk_base_url, hds,
+                                        workers, max_span, executor, progress, track, mux_process, telemetry, job,
+                                        probes.get(track)): (track, filepath)
+                       for track, filepath, init_binary, all_chunks, chunk_base_url in tracks}
+
+        for future in as_completed(futures):
+
+            track, filepath = futures[future]
+
+            if future.result():
+                if mux_process is None:
+                    logger.info(f"{track.capitalize()} file {filepath} successfully created")
+                else:
+                    logger.info(f"{track.capitalize()} stream successfully sent to ffmpeg")
+            else:
+                if mux_process is None:
+                    logger.error(f"Error when generating {track} file {filepath}")
+                else:
+                    logger.error(f"Error when streaming {track} to ffmpeg")
+                result = False
+
+                # Stop ffmpeg so the other tracks do not wait on their pipe
+                if mux_process is not None and mux_process.poll() is None:
+                    mux_process.kill()
+
+    return result
+
+#
+# Download the video and audio tracks straight into ffmpeg through named pipes, without temporary files.
+# Return None if named pipes are not available, else True on success
+#
+def stream_mediafiles(name, tracks, videofileout, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN, executor=None,
+                      telemetry=None, job=None, probes=None):
+
+    outfilepath = os.path.expandvars(os.path.expanduser(videofileout))
+
+    fifofolder = tempfile.mkdtemp(prefix="getvideokmg")
+
+    fifotracks = [(track, os.path.join(fifofolder, track + VIDEOEXTENSION), init_binary, all_chunks, chunk_base_url)
+                  for track, _, init_binary, all_chunks, chunk_base_url in tracks]
+
+    try:
+        try:
+            for fifotrack in fifotracks:
+                os.mkfifo(fifotrack[1])
+        except (AttributeError, OSError) as err:
+            logger.warning(f"Cannot create named pipes: {err}")
+            return None
+
+        extract_cmd = mux_command(fifotracks[0][1], fifotracks[1][1], outfilepath)
+
+        logger.debug(f"Launching command{extract_cmd}")
+
+        try:
+            mux_process = subprocess.Popen(extract_cmd)
+        except OSError as err:
+            logger.warning(f"Cannot start ffmpeg: {err}")
+            return None
+
+        result = download_tracks(name, fifotracks, hds, workers, max_span, mux_process, executor, telemetry, job, probes)
 
-loghandlers=[logging.StreamHandler()]
+        # ffmpeg finishes writing the file once all the tracks are sent
+        start = time.perf_counter()
+
+        mux_process.wait()
+
+        if telemetry is not None and os.path.exists(outfilepath):
+            telemetry.record("mux", time.perf_counter() - start, os.path.getsize(outfilepath))
+
+        if mux_process.returncode != 0:
+            logger.debug(f"Error aggregating video and audio streams: ffmpeg exit code {mux_process.returncode}")
+            return False
+
+        return result
+
+    finally:
+        for fifotrack in fifotracks:
+            if os.path.exists(fifotrack[1]):
+                os.remove(fifotrack[1])
+        os.rmdir(fifofolder)
 
 #
-# Aggregate video and audio stream into one video file
+# Options choosing the video and audio streams of a video. quality is the preferred video width,
+# max_size the maximum size in bytes of video and audio, time_budget the maximum download time in seconds,
+# estimated from the throughput measured on the first probe_segments segments with workers requests at a time
 #
-def aggregate_mediafiles(videofilein, audiofilein, videofileout):
+def selection_policy(quality=QUALITY, max_size=None, time_budget=None, probe_segments=PROBE_SEGMENTS, workers=SEGMENT_WORKERS):
 
-    logger.debug(f"Using ffmpeg binary located at {FFMPEG_BIN_PATH}")
-    logger.debug(f"Writing extracted audio to {videofileout}")
+    return {'quality': quality, 'max_size': max_size, 'time_budget': time_budget,
+            'probe_segments': probe_segments, 'workers': workers}
 
-    #Location of files. Allow to use special variable like ~ in file names
-    videofilepath = os.path.expandvars(os.path.expanduser(videofilein))
-    audiofilepath = os.path.expandvars(os.path.expanduser(audiofilein))
-    outfilepath = os.path.expandvars(os.path.expanduser(videofileout))
+#
+# Size in bytes of the file of a stream
+#
+def stream_size(form):
+
+    return len(base64.b64decode(form['init_segment'])) + sum(chunk_length(chunk) for chunk in form['segments'])
+
+#
+# Bitrate used to compare streams
+#
+def stream_rate(form):
+
+    return form.get('avg_bitrate') or form.get('bitrate', 0)
+
+#
+# Index of the video stream with the width nearest to quality, highest bitrate first for the same width
+#
+def nearest_width_index(videospec, quality):
+
+    return min(range(len(videospec)),
+               key=lambda index: (abs(videospec[index]['width'] - quality), -stream_rate(videospec[index])))
+
+#
+# Index of the stream written in a journal, None if there is no journal or no matching stream
+#
+def journal_stream_index(journalpath, spec):
 
-    extract_cmd = [FFMPEG_BIN_PATH, "-y", "-loglevel", "error", "-stats", "-i", videofilepath, "-i", audiofilepath, "-c:v",  "copy", "-c:a", "copy", outfilepath]
-     
     try:
-        subprocess.run(extract_cmd, capture_output=False, check=True)
-        logger.debug(f"Launching command{extract_cmd}")
+        with open(journalpath, "r", encoding="utf-8") as journal:
+            fingerprint = json.loads(journal.readline()).get('fingerprint')
+    except (OSError, json.JSONDecodeError, AttributeError):
+        return None
 
-    except subprocess.CalledProcessError as err:
-        logger.debug(f"Error aggregating video and audio streams:" + str(err))
-        return False
+    for index, form in enumerate(spec):
+        if journal_fingerprint(base64.b64decode(form['init_segment']), form['segments']) == fingerprint:
+            return index
 
-    return True
+    return None
 
 #
-# Download and assemble binary media chunks into one file
+# Measure the download throughput in bytes per second on the first segments of a stream. Return None on error.
+# The segments downloaded are kept in probes by URL when given, so the download does not request them again
 #
-def write_chunks(outfilepath, firstbinarychunk, allchunks, baseurl, hds):
+def measure_throughput(form, chunk_base_url, hds, probe_segments, workers, probes=None):
 
-    # Write the binary data to an MP4 file
-    with open(outfilepath, "wb") as outfile:
+    chunks = form['segments'][:probe_segments]
 
-        logger.debug(f"Write initial chunk")
+    if not chunks:
+        return None
 
-        outfile.write(firstbinarychunk)
+    writer = MemoryChunkWriter(chunks)
 
-        nb_chunks = len(allchunks)
+    start = time.monotonic()
 
-        index_chunk = 0
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(chunks)))) as executor:
+        results = list(executor.map(lambda index: fetch_chunk(index, chunks[index], chunk_base_url, hds, writer),
+                                    range(len(chunks))))
 
-        logger.debug(f"Found {nb_chunks} chunks ")
+    elapsed = time.monotonic() - start
 
-        try:        
-            # start reading each chunk url
-            for chunk in allchunks:
+    if probes is not None:
+        for index_chunk, result in enumerate(results):
+            if result:
+                probes[chunk_base_url + chunks[index_chunk]['url']] = bytes(writer.pop(index_chunk))
 
-                url = baseurl + chunk['url']
-                logger.debug(f"Chunk {index_chunk} URL {url}")
+    if not all(results) or elapsed <= 0:
+        return None
 
-                resp = requests.get(url, headers=hds)
+    return sum(chunk_length(chunk) for chunk in chunks) / elapsed
 
-                if resp.ok:
-                    logger.debug(f"Chunk {index_chunk} was successfully downloaded")
-                else:
-                    logger.error(f"Chunk {index_chunk} failed to download with status code: {resp.status_code}")
-                    logger.error(f"Chunk {index_chunk} URL {url}")
-                    return False
-                
-                chunk_binary = resp.content
+#
+# Choose the video and audio streams following the policy. Return (video index, audio index).
+# Without a size or time budget, the video nearest to the preferred width and the best audio are chosen.
+# With a budget, the best streams not wider than this video which fit in the budget are chosen.
+# Segments downloaded to measure the throughput are kept in probes by URL when given
+#
+def select_streams(videospec, audiospec, video_base_url, hds, policy, probes=None):
 
-                outfile.write(chunk_binary)
+    quality = policy['quality']
 
-                logger.debug(f"Write segment {index_chunk} in binary file")
+    videoindex = nearest_width_index(videospec, quality)
 
-                index_chunk += 1
+    if videospec[videoindex]['width'] != quality:
+        logger.warning(f"Could not find video stream with width {quality}, using width {videospec[videoindex]['width']}")
 
-        except Exception as err:
-            # log error
-            logger.error("Error reading chunks :" + str(err))               
-            return False
+    audio_by_rate = sorted(range(len(audiospec)),
+                           key=lambda index: (audiospec[index].get('bitrate', 0), audiospec[index].get('avg_bitrate', 0)),
+                           reverse=True)
 
-    logger.debug(f"Ouput file {outfilepath} ready")
+    budget = policy['max_size']
+
+    if policy['time_budget']:
+
+        probe_url = urljoin(video_base_url, videospec[videoindex]['base_url'])
+
+        throughput = measure_throughput(videospec[videoindex], probe_url, hds, policy['probe_segments'], policy['workers'],
+                                        probes)
 
-    return True      
+        if throughput:
+            logger.info(f"Measured throughput {throughput / (1024 * 1024):.1f} MiB/s")
+            time_size = throughput * policy['time_budget']
+            budget = time_size if budget is None else min(budget, time_size)
+        else:
+            logger.warning(f"Cannot measure throughput, download time budget ignored")
+
+    if budget is None:
+        return videoindex, audio_by_rate[0]
+
+    video_by_rate = sorted((index for index in range(len(videospec)) if videospec[index]['width'] <= videospec[videoindex]['width']),
+                           key=lambda index: stream_rate(videospec[index]), reverse=True)
+
+    # Lower the video first, audio only if the smallest video does not fit with the best audio
+    for audioindex in audio_by_rate:
+        for index in video_by_rate:
+            if stream_size(videospec[index]) + stream_size(audiospec[audioindex]) <= budget:
+                return index, audioindex
+
+    logger.warning(f"No streams fit in {budget / (1024 * 1024):.1f} MiB, using the smallest ones")
+
+    return video_by_rate[-1], audio_by_rate[-1]
 
 #
-# Main function to get the video from the playlist URL
+# Clip id and expiry timestamp of a signed playlist URL like .../exp=<timestamp>~acl=...~hmac=.../<clip id>/...
+# Return (None, None) if the URL is not signed
+#
+def playlist_url_info(videourl):
+
+    path_parts = urlparse(videourl).path.split('/')
+
+    for index, part in enumerate(path_parts):
+
+        if not part.startswith("exp="):
+            continue
+
+        try:
+            expires = int(part[len("exp="):].split('~', 1)[0])
+        except ValueError:
+            return None, None
+
+        clipid = path_parts[index + 1] if index + 1 < len(path_parts) and path_parts[index + 1] else None
+
+        return clipid, expires
+
+    return None, None
+
+#
+# Check that a playlist has the fields used to download a video. Return the error, or None if valid
+#
+def check_playlist(playlist):
+
+    if not isinstance(playlist, dict):
+        return "not a JSON object"
+
+    for key in ('clip_id', 'base_url', 'video', 'audio'):
+        if key not in playlist:
+            return f"no {key}"
+
+    for kind in ('video', 'audio'):
+
+        if not playlist[kind]:
+            return f"no {kind} stream"
+
+        for form in playlist[kind]:
+            if not form.get('init_segment') or 'base_url' not in form or not form.get('segments'):
+                return f"incomplete {kind} stream"
+
+    return None
+
+#
+# Playlist of a clip found in the cache, None if not found or if its link expires too soon
+#
+def cached_playlist(clipid):
+
+    with playlist_cache_lock:
+        entry = playlist_cache.get(clipid)
+
+    if entry is None and playlist_cache_dir is not None:
+
+        try:
+            with open(os.path.join(playlist_cache_dir, clipid + ".json"), "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (OSError, json.JSONDecodeError):
+            entry = None
+
+    if entry is None or entry.get('expires', 0) - time.time() < PLAYLIST_EXPIRY_MARGIN:
+        return None
+
+    return entry
+
+#
+# Keep a playlist in the cache until its link expires
+#
+def store_playlist(clipid, entry):
+
+    with playlist_cache_lock:
+        playlist_cache[clipid] = entry
+
+    if playlist_cache_dir is None:
+        return
+
+    try:
+        Path(playlist_cache_dir).mkdir(parents=True, exist_ok=True)
+
+        cachepath = os.path.join(playlist_cache_dir, clipid + ".json")
+
+        with open(cachepath + ".tmp", "w", encoding="utf-8") as file:
+            json.dump(entry, file)
+
+        os.replace(cachepath + ".tmp", cachepath)
+
+    except OSError as err:
+        logger.warning(f"Cannot save playlist of clip {clipid} in cache: {err}")
+
+#
+# Get the playlist of a video from the cache, else download and check it.
+# Return (playlist, URL of the playlist, status). The URL is the one the playlist was downloaded from,
+# its links stay valid until it expires. playlist is None when status is not "ok"
+#
+def fetch_playlist(videourl, hds, telemetry=None):
+
+    clipid, expires = playlist_url_info(videourl)
+
+    if clipid is not None:
+
+        entry = cached_playlist(clipid)
+
+        if entry is not None:
+            logger.info(f"Playlist of clip {clipid} found in cache, valid until {time.ctime(entry['expires'])}")
+            return entry['playlist'], entry['url'], "ok"
+
+    if expires is not None and expires <= time.time():
+        logger.error(f"Playlist URL expired on {time.ctime(expires)}")
+        logger.error(f"Playlist URL {videourl}")
+        return None, videourl, "link expired"
+
+    if telemetry is None:
+        telemetry = Telemetry.Telemetry()
+
+    with telemetry.measure("playlist_fetch") as sample:
+        resp = HttpTransport.get(videourl, headers=hds)
+        sample.nbytes = len(resp.content)
+
+    if resp.ok:
+        logger.info(f"Playlist was successfully downloaded")
+    else:
+        logger.error(f"Playlist failed to download with status code: {resp.status_code}")
+        logger.error(f"Playlist URL {videourl}")
+        return None, videourl, "playlist failed"
+
+    try:
+        playlist = json.loads(resp.content.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as err:
+        playlist = None
+        error = str(err)
+    else:
+        error = check_playlist(playlist)
+
+    if error is not None:
+        logger.error(f"Invalid playlist: {error}")
+        logger.error(f"Playlist URL {videourl}")
+        return None, videourl, "invalid playlist"
+
+    if clipid is not None:
+        store_playlist(clipid, {'url': videourl, 'expires': expires, 'playlist': playlist})
+
+    return playlist, videourl, "ok"
+
+#
+# Download and check the playlists of all the rows at the same time, so broken or expired links
+# are found before the downloads start. Return the status of each row by row number
+#
+def prefetch_playlists(rows, hds, jobs=PREFETCH_JOBS):
+
+    statuses = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        futures = {executor.submit(fetch_playlist, video_url, hds): (index_row, video_name)
+                   for index_row, (video_name, video_url) in enumerate(rows, start=1)}
+
+        for future in as_completed(futures):
+
+            index_row, video_name = futures[future]
+
+            try:
+                status = future.result()[2]
+            except Exception as err:
+                logger.error(f"Error checking playlist of {video_name}: {err}")
+                status = "playlist failed"
+
+            statuses[index_row] = status
+
+    return statuses
+
+#
+# Download the playlist and choose the video and audio streams following the policy.
+# Return the video to download as a dictionary, or None on error
 #
-def get_video(outputfilepath, videourl, hds):
+def prepare_video(outputfilepath, videourl, hds, policy=None):
+
+    if policy is None:
+        policy = selection_policy()
 
     outfilename = os.path.basename(outputfilepath)
     outfolder = os.path.dirname(outputfilepath)
@@ -129,20 +1689,17 @@ def get_video(outputfilepath, videourl, hds):
 
     audiofilepath  = os.path.join(outfolder, audiofilename)
 
-    url_parts = videourl.split(URL_SEPARATOR, 1)
+    telemetry = Telemetry.Telemetry()
 
-    stub_url = url_parts[0]
+    playlist, playlisturl, _ = fetch_playlist(videourl, hds, telemetry)
 
-    resp = requests.get(videourl, headers=hds)
+    if playlist is None:
+        return None
 
-    if resp.ok:
-        logger.info(f"Playlist was successfully downloaded")
-    else:
-        logger.error(f"Playlist failed to download with status code: {resp.status_code}")
-        logger.error(f"Playlist URL {videourl}")
-        return False
+    # Segment URLs are relative to the URL the playlist was downloaded from
+    url_parts = playlisturl.split(URL_SEPARATOR, 1)
 
-    playlist = json.loads(resp.content.decode("utf-8"))
+    stub_url = url_parts[0]
 
     clipid = playlist['clip_id']
     baseurl= playlist['base_url']
@@ -158,25 +1715,29 @@ def get_video(outputfilepath, videourl, hds):
 
     logger.debug(f"Video base URL: {video_base_url}")
 
-    videoindex = 0
-    videofound = False
+    for videoindex, videoform in enumerate(videospec):
+        logger.debug(f"Video {videoindex} width is {videoform['width']}, bitrate is {stream_rate(videoform)}")
 
-    # Find video with expected resolution
-    for videoform in videospec:
+    for audioindex, audioform in enumerate(audiospec):
+        logger.debug(f"Audio {audioindex} bitrate is {audioform['bitrate']}")
 
-        width = videoform['width']
-        
-        logger.debug(f"Video {videoindex} width is {width}")
+    probes = {}
 
-        if videoform['width'] == QUALITY:
-            videofound = True
-            break
-        else:
-            videoindex += 1
+    videoindex, bestindex = select_streams(videospec, audiospec, video_base_url, hds, policy, probes)
 
-    if not videofound:
-        logger.error(f"Could not find video stream with width {width}")
-        return False      
+    # A download being resumed keeps the streams of its journals
+    resumed_video = journal_stream_index(videofilepath + JOURNALEXTENSION, videospec)
+    resumed_audio = journal_stream_index(audiofilepath + JOURNALEXTENSION, audiospec)
+
+    if resumed_video is not None:
+        videoindex = resumed_video
+
+    if resumed_audio is not None:
+        bestindex = resumed_audio
+
+    logger.info(f"Chosen video stream width {videospec[videoindex]['width']} at {stream_rate(videospec[videoindex])} bit/s, "
+                f"audio stream at {audiospec[bestindex]['bitrate']} bit/s, "
+                f"{(stream_size(videospec[videoindex]) + stream_size(audiospec[bestindex])) / (1024 * 1024):.1f} MiB")
 
     # Initial segment of the mp4 file is in the playlist file
     initvideosegment = videospec[videoindex]['init_segment']
@@ -192,39 +1753,17 @@ def get_video(outputfilepath, videourl, hds):
     logger.debug(f"Video chunk base URL: {chunk_base_url}")
 
     # Decode Base64 string into binary data
-    init_binary = base64.b64decode(initvideosegment)
-
-    logger.debug(f"Opening video binary file to write video segments found in playlist")
-    
-    all_chunks = videospec[videoindex]["segments"]
-
-    result = write_chunks(videofilepath, init_binary, all_chunks, chunk_base_url, hds)
-
-    if result :
-        logger.info(f"Video file {videofilepath} successfully created")
-    else:
-        logger.error(f"Error when generating video file {videofilepath}") 
-        return False       
+    with telemetry.measure("init_decode") as sample:
+        init_video_binary = base64.b64decode(initvideosegment)
+        sample.nbytes = len(init_video_binary)
 
-    # Find audio with best quality
-    audioindex = 0
-
-    bestrate = audiospec[audioindex]['bitrate']
-    bestindex = 0
-
-    # Find best bitrate
-    for audioform in audiospec:
-
-        bitrate = audioform['bitrate']
-        
-        logger.debug(f"Audio {audioindex} bitrate is {bitrate}")
+    all_video_chunks = videospec[videoindex]["segments"]
 
-        if bitrate > bestrate:
-            bestindex = audioindex
-        else:
-            audioindex += 1
+    video_chunk_base_url = chunk_base_url
 
-    logger.debug(f"Best bitrate is {bestrate} at index {bestindex}")
+    # Segments of the chosen stream already downloaded to measure the throughput
+    video_probes = {index_chunk: probes[chunk_base_url + chunk['url']] for index_chunk, chunk in enumerate(all_video_chunks)
+                    if chunk_base_url + chunk['url'] in probes}
 
     # Initial segment of the mp4 file is in the playlist file
     initaudiosegment = audiospec[bestindex]['init_segment']
@@ -240,21 +1779,35 @@ def get_video(outputfilepath, videourl, hds):
     logger.debug(f"Audio chunk base URL: {chunk_base_url}")
 
     # Decode Base64 string into binary data
-    init_binary = base64.b64decode(initaudiosegment)
+    with telemetry.measure("init_decode") as sample:
+        init_audio_binary = base64.b64decode(initaudiosegment)
+        sample.nbytes = len(init_audio_binary)
 
-    all_chunks = audiospec[bestindex]["segments"]
+    all_audio_chunks = audiospec[bestindex]["segments"]
 
-    logger.debug(f"Opening audio binary file to write segments found in playlist")
+    audio_chunk_base_url = chunk_base_url
 
-    result = write_chunks(audiofilepath, init_binary, all_chunks, chunk_base_url, hds)
+    logger.debug(f"Opening video and audio binary files to write segments found in playlist")
 
-    if result :
-        logger.info(f"Audio file {audiofilepath} successfully created")
-    else:
-        logger.error(f"Error when generating audio file {audiofilepath}")
-        return False
+    tracks = [("video", videofilepath, init_video_binary, all_video_chunks, video_chunk_base_url),
+              ("audio", audiofilepath, init_audio_binary, all_audio_chunks, audio_chunk_base_url)]
+
+    return {'name': outfilecore, 'output': outputfilepath, 'tracks': tracks, 'telemetry': telemetry,
+            'probes': {'video': video_probes}}
+
+#
+# Merge the downloaded video and audio files of a video and delete them
+#
+def mux_video(video):
+
+    outputfilepath = video['output']
+    videofilepath = video['tracks'][0][1]
+    audiofilepath = video['tracks'][1][1]
+
+    start = time.perf_counter()
 
     if aggregate_mediafiles(videofilepath, audiofilepath, outputfilepath) :
+        video['telemetry'].record("mux", time.perf_counter() - start, os.path.getsize(outputfilepath))
         logger.info(f"Final video file {outputfilepath} successfully created")
     else:
         logger.error(f"Error when generating final file {outputfilepath}")
@@ -262,12 +1815,162 @@ def get_video(outputfilepath, videourl, hds):
     
     logger.info(f"Delete temporary video file {videofilepath}")
     os.remove(videofilepath)
+    os.remove(videofilepath + JOURNALEXTENSION)
 
     logger.info(f"Delete temporary audio file {audiofilepath}")
     os.remove(audiofilepath)
+    os.remove(audiofilepath + JOURNALEXTENSION)
 
     return True
 
+#
+# Download the tracks of a video, straight into ffmpeg when stream is set.
+# The video is one job of the rate limit, getting its fair share while other videos of a batch are downloaded.
+# Return True when the final file is created, False on error, None when the tracks are ready to merge
+#
+def download_video(video, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN, stream=False, executor=None):
+
+    with bandwidth.join() as job:
+
+        tracks = video['tracks']
+
+        # A download interrupted in temporary files is resumed with temporary files
+        resuming = any(os.path.exists(track[1] + JOURNALEXTENSION) for track in tracks)
+
+        if stream and not resuming:
+
+            result = stream_mediafiles(video['name'], tracks, video['output'], hds, workers, max_span, executor, video['telemetry'], job,
+                                       video['probes'])
+
+            if result:
+                logger.info(f"Final video file {video['output']} successfully created")
+                return True
+
+            logger.warning(f"Streaming into ffmpeg failed, downloading to temporary files")
+
+        if not download_tracks(video['name'], tracks, hds, workers, max_span, None, executor, video['telemetry'], job,
+                               video['probes']):
+            return False
+
+        return None
+
+#
+# Main function to get the video from the playlist URL
+#
+def get_video(outputfilepath, videourl, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN, stream=False, policy=None):
+
+    video = prepare_video(outputfilepath, videourl, hds, policy)
+
+    if video is None:
+        return False
+
+    result = download_video(video, hds, workers, max_span, stream)
+
+    if result is not None:
+        return result
+
+    # Merge starts as soon as both tracks are downloaded
+    return mux_video(video)
+
+#
+# Download one video of a batch and queue the merge of its tracks in the muxer.
+# The telemetry of the video is added to reports when given.
+# Return the future of the merge, or the status of the video when there is nothing to merge
+#
+def schedule_video(outputfilepath, videourl, hds, workers, max_span, stream, policy, executor, muxer, reports=None):
+
+    logger.info(f"Getting video file {os.path.basename(outputfilepath)}")
+
+    try:
+        video = prepare_video(outputfilepath, videourl, hds, policy)
+
+        if video is None:
+            return "playlist failed"
+
+        if reports is not None:
+            reports[video['name']] = video['telemetry']
+
+        result = download_video(video, hds, workers, max_span, stream, executor)
+
+    except Exception as err:
+        logger.error(f"Error downloading {outputfilepath}: {err}")
+        return "download failed"
+
+    if result is False:
+        return "download failed"
+
+    # Video was streamed into ffmpeg
+    if result is True:
+        return "ok"
+
+    return muxer.submit(mux_video, video)
+
+#
+# Download all the videos of a batch. Up to batch_videos videos are downloaded at the same time
+# and share the workers, so at most workers segments are downloaded at once.
+# Tracks are merged by a separate stage so merging a video overlaps the download of the next ones.
+# The telemetry of each video is added to reports, by video name, when given.
+# Rows listed in skipped, by row number, are not downloaded and keep their status.
+# Return the list of (row, output file path, status)
+#
+def run_batch(rows, outfolder, hds, workers=SEGMENT_WORKERS, max_span=COALESCE_MAX_SPAN, stream=False, batch_videos=BATCH_VIDEOS,
+              policy=None, reports=None, skipped=None):
+
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+         ThreadPoolExecutor(max_workers=1) as muxer, \
+         ThreadPoolExecutor(max_workers=batch_videos) as downloads:
+
+        futures = {}
+
+        for index_row, (video_name, video_url) in enumerate(rows, start=1):
+
+            videofilepath = os.path.join(outfolder, video_name + VIDEOEXTENSION)
+
+            if skipped and index_row in skipped:
+                results[index_row] = (index_row, videofilepath, skipped[index_row])
+                continue
+
+            futures[downloads.submit(schedule_video, videofilepath, video_url, hds, workers, max_span, stream, policy,
+                                     executor, muxer, reports)] = (index_row, videofilepath)
+
+        mux_futures = {}
+
+        for future in as_completed(futures):
+
+            index_row, videofilepath = futures[future]
+
+            scheduled = future.result()
+
+            if scheduled == "ok":
+                logger.info(f"Video file {videofilepath} successfully downloaded")
+                results[index_row] = (index_row, videofilepath, scheduled)
+            elif isinstance(scheduled, str):
+                logger.error(f"Error when generating video file {videofilepath}")
+                results[index_row] = (index_row, videofilepath, scheduled)
+            else:
+                mux_futures[scheduled] = (index_row, videofilepath)
+
+        for future in as_completed(mux_futures):
+
+            index_row, videofilepath = mux_futures[future]
+
+            try:
+                muxed = future.result()
+            except Exception as err:
+                logger.error(f"Error merging {videofilepath}: {err}")
+                muxed = False
+
+            if muxed:
+                logger.info(f"Video file {videofilepath} successfully downloaded")
+                results[index_row] = (index_row, videofilepath, "ok")
+            else:
+                logger.error(f"Error when generating video file {videofilepath}")
+                results[index_row] = (index_row, videofilepath, "merge failed")
+
+    return [results[index_row] for index_row in sorted(results)]
+
 # Main function
 def main(argv):
     # Default logging level
@@ -314,27 +2017,112 @@ def main(argv):
     # Get the headers to be used at each calls
     hds = data['headers']
 
+    global HEDGE_PERCENTILE, SEGMENT_DEADLINE, READ_BLOCK_SIZE, segment_cache, playlist_cache_dir, bandwidth
+    HEDGE_PERCENTILE = args.hedge_percentile
+    SEGMENT_DEADLINE = args.deadline
+    READ_BLOCK_SIZE = args.block_size * 1024
+
+    playlist_cache_dir = args.playlist_cache
+
+    if args.cache_dir:
+        segment_cache = SegmentCache.SegmentCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        logger.info(f"Segment cache {segment_cache.folder}: {segment_cache.total / (1024 * 1024):.0f} MiB in {len(segment_cache.entries)} segments")
+
+    try:
+        bandwidth = RateLimiter.RateLimiter(RateLimiter.parse_rate(args.limit_rate), args.rate_file)
+    except ValueError as err:
+        logger.error(str(err))
+        return False
+
+    # The rate file can be changed while the batch runs, and read at once with kill -USR1
+    bandwidth.install_signal()
+
+    if bandwidth.rate or args.rate_file:
+        logger.info(f"Download rate limited to {RateLimiter.format_rate(bandwidth.rate)}")
+
+    # Connections are kept open and shared by all the downloads of the batch
+    HttpTransport.configure(pool_size=args.host_connections, retries=args.retries, read_timeout=args.timeout)
+
     with open(args.urls_file, "r", newline="", encoding="utf-8") as file:
         reader = csv.reader(file)  # Create a CSV reader object
         
-        for row in reader:  # Iterate through each row
-            video_filename = row[0] + VIDEOEXTENSION
-            video_url = row[1]
-            logger.info(f"Getting video file {video_filename}")
+        rows = [(row[0], row[1]) for row in reader]  # Name and playlist URL of each video
 
-            videofilepath  = os.path.join(outfolder, video_filename)
+    skipped = {}
 
-            result = get_video(videofilepath, video_url, hds)
+    # Check all the links before starting downloads which can take hours
+    if args.prefetch or args.check:
 
-            if result :
-                logger.info(f"Video file {videofilepath} successfully downloaded")
+        statuses = prefetch_playlists(rows, hds)
+
+        expiries = []
+
+        for index_row, (video_name, video_url) in enumerate(rows, start=1):
+            if statuses[index_row] == "ok":
+                logger.info(f"Row {index_row} {video_name}: playlist ok")
+                # A cached playlist may come from another link of the same clip
+                clipid, expires = playlist_url_info(video_url)
+                entry = cached_playlist(clipid) if clipid is not None else None
+                if entry is not None or expires is not None:
+                    expiries.append(entry['expires'] if entry is not None else expires)
             else:
-                logger.error(f"Error when generating video file {videofilepath}")
-                continue
+                logger.error(f"Row {index_row} {video_name}: {statuses[index_row]}")
+                skipped[index_row] = statuses[index_row]
+
+        logger.info(f"{len(rows) - len(skipped)} of {len(rows)} playlists are valid")
+
+        if expiries:
+            logger.info(f"First link expires on {time.ctime(min(expiries))}")
+
+        if args.check:
+            sys.exit(0 if not skipped else 1)
+
+    # Size and time budgets are given in MiB and minutes
+    policy = selection_policy(args.quality,
+                              args.max_size * 1024 * 1024 if args.max_size else None,
+                              args.time_budget * 60 if args.time_budget else None,
+                              args.probe_segments,
+                              args.workers)
+
+    reports = {}
+
+    results = run_batch(rows, outfolder, hds, args.workers, args.max_span * 1024 * 1024, args.stream, args.batch_videos, policy,
+                        reports, skipped)
 
     logger.info(f"Finish all download of video files")
 
-    sys.exit(0)
+    if segment_cache is not None:
+        logger.info(f"Segment cache: {segment_cache.hits} hits, {segment_cache.misses} misses")
+
+    # Batch telemetry sums the telemetry of all the videos
+    if args.metrics_json or args.metrics_prom:
+
+        batch_telemetry = Telemetry.Telemetry()
+
+        for telemetry in reports.values():
+            batch_telemetry.merge(telemetry)
+
+        for stage, histogram in batch_telemetry.to_dict().items():
+            logger.info(f"{stage}: {histogram['count']} in {histogram['seconds']:.1f}s, {histogram['bytes'] / (1024 * 1024):.1f} MiB")
+
+        if args.metrics_json:
+            Telemetry.write_json(os.path.join(outfolder, args.metrics_json), batch_telemetry, reports)
+
+        if args.metrics_prom:
+            Telemetry.write_prometheus(os.path.join(outfolder, args.metrics_prom), batch_telemetry, reports)
+
+    # Summary of the batch
+    failed = [result for result in results if result[2] != "ok"]
+
+    logger.info(f"{len(results) - len(failed)} of {len(results)} videos successfully downloaded")
+
+    for index_row, videofilepath, status in results:
+        if status == "ok":
+            logger.info(f"Row {index_row} {os.path.basename(videofilepath)}: {status}")
+        else:
+            logger.error(f"Row {index_row} {os.path.basename(videofilepath)}: {status}")
+
+    sys.exit(0 if not failed else 1)
 
 
 # main program  
@@ -346,6 +2134,29 @@ if __name__ == "__main__":
     parser.add_argument("out_folder", help="Output folder full path")
     parser.add_argument("-l", "--log-file", help="Path to log file")
     parser.add_argument("-v", "--log-level", help="Log level: D=Debug, W=Warning, E=Error, I=Info (default)")
+    parser.add_argument("-w", "--workers", type=int, default=SEGMENT_WORKERS, help="Number of segments downloaded in parallel across all videos (default 1)")
+    parser.add_argument("-b", "--batch-videos", type=int, default=BATCH_VIDEOS, help="Number of videos downloaded at the same time (default 1)")
+    parser.add_argument("--host-connections", type=int, default=HttpTransport.POOL_SIZE, help="Maximum number of connections to one host (default 8)")
+    parser.add_argument("--retries", type=int, default=HttpTransport.RETRIES, help="Number of retries of a failed request (default 3)")
+    parser.add_argument("--timeout", type=int, default=HttpTransport.READ_TIMEOUT, help="Seconds to wait for data before a request fails (default 60)")
+    parser.add_argument("--hedge-percentile", type=int, default=HEDGE_PERCENTILE, help="Send a duplicate request for segments slower than this percentile of recent segments, 0 to disable (default 95)")
+    parser.add_argument("--deadline", type=int, default=SEGMENT_DEADLINE, help="Maximum seconds to download one segment (default 300)")
+    parser.add_argument("--block-size", type=int, default=READ_BLOCK_SIZE // 1024, help="Size in KiB of the blocks read from the network and written to disk (default 64)")
+    parser.add_argument("-m", "--max-span", type=int, default=COALESCE_MAX_SPAN, help="Merge contiguous segments into range requests of at most this size in MiB (default 0, disabled)")
+    parser.add_argument("-s", "--stream", action='store_true', help="Stream segments into ffmpeg without temporary video and audio files")
+    parser.add_argument("-q", "--quality", type=int, default=QUALITY, help="Preferred video width, nearest width if not available (default 1280)")
+    parser.add_argument("--max-size", type=int, help="Maximum size in MiB of each video, lower quality streams are chosen to fit")
+    parser.add_argument("--time-budget", type=int, help="Maximum download time in minutes of each video, estimated from the measured throughput")
+    parser.add_argument("--probe-segments", type=int, default=PROBE_SEGMENTS, help="Number of segments downloaded to measure the throughput (default 3)")
+    parser.add_argument("-p", "--prefetch", action='store_true', help="Download and check all the playlists at the same time before downloading the videos")
+    parser.add_argument("-c", "--check", action='store_true', help="Only download and check all the playlists, no video is downloaded")
+    parser.add_argument("--playlist-cache", help="Folder where playlists are kept until their link expires, for the next runs")
+    parser.add_argument("--cache-dir", help="Folder of the segment cache shared by all runs, no cache if not set")
+    parser.add_argument("--limit-rate", help="Maximum download rate in bytes per second, with an optional K, M or G suffix, for example 2M (default no limit)")
+    parser.add_argument("--rate-file", help="File holding the maximum download rate, checked while downloading so it can be changed at any time")
+    parser.add_argument("--cache-size", type=int, default=SegmentCache.MAX_BYTES // (1024 * 1024), help="Maximum size in MiB of the segment cache (default 2048)")
+    parser.add_argument("--metrics-json", help="Path of the JSON report of the download stage timings, relative to the output folder")
+    parser.add_argument("--metrics-prom", help="Path of the Prometheus textfile of the download stage timings, relative to the output folder")
 
     args = parser.parse_args()
 
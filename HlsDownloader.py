@@ -0,0 +1,397 @@
+"""
+HlsDownloader.py
+
+Native HLS downloader used by DownloadVideosCurl.py as an alternative to yt-dlp.
+Fragments of the media playlist are downloaded in parallel with the headers of the
+parsed curl command, written in order into a .part file and streamed at the same
+time into ffmpeg, which remuxes them into the output file.
+
+Usage:
+  import HlsDownloader
+  HlsDownloader.download_hls(m3u8_url, headers, "video.mp4", workers=8, retries=3)
+  HlsDownloader.download_hls(m3u8_url, headers, "video.mp4", limiter=RateLimiter.RateLimiter(2 * 1024**2))
+
+Notes:
+- A master playlist is resolved to its variant with the highest bandwidth.
+  Alternative audio renditions are not downloaded.
+- Encrypted playlists (EXT-X-KEY other than NONE) are not supported, use yt-dlp.
+- A journal next to the .part file lists the fragments already written. Running the
+  download again only fetches the missing fragments; ffmpeg remuxes the whole file
+  again from the .part file.
+- Without ffmpeg, the .part file is renamed to the output file as is.
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
+import requests
+
+import HttpTransport
+
+# Number of fragments downloaded in parallel for one video
+FRAGMENT_WORKERS = 4
+
+# Number of retries of a fragment and base delay in seconds between retries.
+# Come on top of the retries of HttpTransport, also cover connections dropped during the body
+FRAGMENT_RETRIES = 3
+FRAGMENT_BACKOFF = 1.0
+
+# Download progress is reported each time this percentage is reached
+PROGRESS_STEP = 10
+
+FFMPEG_BIN_PATH = 'ffmpeg'
+
+PART_EXTENSION = ".part"
+JOURNAL_EXTENSION = ".fragments"
+
+# Size of the blocks copied from the .part file into ffmpeg when resuming
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Size of the blocks read from the network, each one counted by the rate limiter
+READ_BLOCK_SIZE = 64 * 1024
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+
+def _attributes(line: str) -> dict:
+    """
+    Attributes of an m3u8 tag like #EXT-X-MAP:URI="init.mp4",BYTERANGE="720@0".
+    """
+    values = line.split(":", 1)[1] if ":" in line else ""
+    return {key: value.strip('"') for key, value in _ATTRIBUTE.findall(values)}
+
+
+def _byterange(spec: str, default_offset: int):
+    """
+    Inclusive (start, end) of a byte range spec "<length>[@<offset>]".
+    """
+    length, _, offset = spec.partition("@")
+    start = int(offset) if offset else default_offset
+    return start, start + int(length) - 1
+
+
+def parse_m3u8(text: str, url: str) -> dict:
+    """
+    Parse an m3u8 playlist. Return {'variants': [(bandwidth, url)], 'init': fragment or None,
+    'fragments': [fragment]}, each fragment being {'url': ..., 'range': (start, end) or None}.
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+
+    if not lines or not lines[0].startswith("#EXTM3U"):
+        raise ValueError("not an m3u8 playlist")
+
+    variants = []
+    fragments = []
+    init = None
+    variant = None
+    byterange = None
+    # End of the last range of each URI, where the next range starts by default
+    range_ends = {}
+
+    for line in lines[1:]:
+
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            variant = _attributes(line)
+
+        elif line.startswith("#EXT-X-MAP:"):
+            attributes = _attributes(line)
+            init_url = urljoin(url, attributes['URI'])
+            init_range = _byterange(attributes['BYTERANGE'], 0) if 'BYTERANGE' in attributes else None
+            init = {'url': init_url, 'range': init_range}
+
+        elif line.startswith("#EXT-X-KEY:"):
+            method = _attributes(line).get('METHOD', 'NONE')
+            if method != 'NONE':
+                raise ValueError(f"encrypted playlist ({method}) not supported")
+
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            byterange = line.split(":", 1)[1]
+
+        elif line.startswith("#"):
+            continue
+
+        elif variant is not None:
+            variants.append((int(variant.get('BANDWIDTH', 0)), urljoin(url, line)))
+            variant = None
+
+        else:
+            fragment_url = urljoin(url, line)
+            fragment_range = None
+            if byterange is not None:
+                fragment_range = _byterange(byterange, range_ends.get(fragment_url, 0))
+                range_ends[fragment_url] = fragment_range[1] + 1
+                byterange = None
+            fragments.append({'url': fragment_url, 'range': fragment_range})
+
+    return {'variants': variants, 'init': init, 'fragments': fragments}
+
+
+def load_media_playlist(url: str, headers: dict) -> dict:
+    """
+    Download the playlist at url, following a master playlist to its best variant.
+    """
+    for _ in range(2):
+
+        resp = HttpTransport.get(url, headers=headers)
+
+        if not resp.ok:
+            raise IOError(f"playlist {url} failed to download with status code {resp.status_code}")
+
+        playlist = parse_m3u8(resp.text, resp.url or url)
+
+        if not playlist['variants']:
+            if not playlist['fragments']:
+                raise ValueError(f"playlist {url} has no fragment")
+            return playlist
+
+        url = max(playlist['variants'])[1]
+
+    raise ValueError("master playlist links to another master playlist")
+
+
+def fetch_fragment(fragment: dict, headers: dict, retries: int = FRAGMENT_RETRIES, job=None) -> bytes:
+    """
+    Download one fragment, retrying failed and incomplete answers.
+    With job, a RateLimiter.JobShare, the body is read within the rate limit.
+    """
+    fragment_headers = dict(headers)
+
+    if fragment['range'] is not None:
+        start, end = fragment['range']
+        fragment_headers['Range'] = f"bytes={start}-{end}"
+
+    error = None
+
+    for attempt in range(retries + 1):
+
+        if attempt:
+            time.sleep(FRAGMENT_BACKOFF * 2 ** (attempt - 1))
+
+        data = bytearray()
+
+        try:
+            with HttpTransport.get(fragment['url'], headers=fragment_headers, stream=True) as resp:
+
+                if not resp.ok:
+                    error = f"status code {resp.status_code}"
+                    continue
+
+                for block in resp.iter_content(READ_BLOCK_SIZE):
+                    if job is not None:
+                        job.consume(len(block))
+                    data += block
+
+        except requests.RequestException as err:
+            error = str(err)
+            continue
+
+        if fragment['range'] is not None and len(data) != end - start + 1:
+            error = f"{len(data)} bytes received, expected {end - start + 1}"
+            continue
+
+        return bytes(data)
+
+    raise IOError(f"fragment {fragment['url']} failed: {error}")
+
+
+def playlist_fingerprint(fragments: list) -> str:
+    """
+    Identify the fragments of a playlist without the signed query strings, which change.
+    """
+    digest = hashlib.sha1()
+
+    for fragment in fragments:
+        digest.update(f"{fragment['url'].split('?', 1)[0]} {fragment['range']}\n".encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def read_fragment_journal(journalpath: str, partpath: str, fingerprint: str, nb_fragments: int) -> list:
+    """
+    Sizes of the fragments already written in order in the .part file, empty to start again.
+    """
+    if not os.path.exists(journalpath) or not os.path.exists(partpath):
+        return []
+
+    sizes = []
+
+    try:
+        with open(journalpath, "r", encoding="utf-8") as journal:
+
+            header = json.loads(journal.readline())
+
+            if header.get('fingerprint') != fingerprint or header.get('fragments') != nb_fragments:
+                return []
+
+            for line in journal:
+                parts = line.split()
+                # Last line may be incomplete if the previous run was interrupted
+                if len(parts) != 2 or not parts[1].isdigit() or parts[0] != str(len(sizes)):
+                    break
+                sizes.append(int(parts[1]))
+
+    except (json.JSONDecodeError, AttributeError, OSError):
+        return []
+
+    # The .part file may miss the end of the last fragment written
+    while sizes and sum(sizes) > os.path.getsize(partpath):
+        sizes.pop()
+
+    return sizes
+
+
+def start_remux(output_file: str, errors):
+    """
+    Start ffmpeg remuxing the fragments written on its input into output_file.
+    Its messages are written to the file errors: a pipe only read at the end would
+    block ffmpeg once full, and the download with it.
+    Return None if ffmpeg cannot be started.
+    """
+    command = [FFMPEG_BIN_PATH, "-y", "-loglevel", "error", "-i", "pipe:0", "-c", "copy", output_file]
+
+    try:
+        return subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=errors)
+    except OSError:
+        return None
+
+
+def _remux_error(errors) -> RuntimeError:
+    """
+    Error of an ffmpeg remux process which has exited, with its messages read from the file errors.
+    """
+    errors.seek(0)
+    return RuntimeError(f"ffmpeg remux failed: {errors.read().decode('utf-8', 'replace').strip()}")
+
+
+def _feed_remux(mux, errors, data):
+    """
+    Write data on the input of the ffmpeg remux process. If ffmpeg has already exited,
+    wait for it and raise its error rather than the broken pipe.
+    """
+    try:
+        mux.stdin.write(data)
+    except BrokenPipeError:
+        mux.wait()
+        raise _remux_error(errors) from None
+
+
+def download_hls(url: str, headers: dict, output_file: str, workers: int = FRAGMENT_WORKERS,
+                 retries: int = FRAGMENT_RETRIES, report=print, limiter=None):
+    """
+    Download the HLS stream at url into output_file with workers fragments in parallel.
+    Messages are passed to report. With limiter, a RateLimiter.RateLimiter, the download
+    is one job sharing its rate. Raise an exception on failure; the fragments already
+    written are kept for the next run.
+    """
+    if limiter is not None:
+        with limiter.join() as job:
+            return _download_hls(url, headers, output_file, workers, retries, report, job)
+
+    return _download_hls(url, headers, output_file, workers, retries, report, None)
+
+
+def _download_hls(url, headers, output_file, workers, retries, report, job):
+    playlist = load_media_playlist(url, headers)
+
+    fragments = ([playlist['init']] if playlist['init'] else []) + playlist['fragments']
+    nb_fragments = len(fragments)
+
+    partpath = output_file + PART_EXTENSION
+    journalpath = output_file + JOURNAL_EXTENSION
+
+    fingerprint = playlist_fingerprint(fragments)
+
+    sizes = read_fragment_journal(journalpath, partpath, fingerprint, nb_fragments)
+
+    if sizes:
+        report(f"Resuming: {len(sizes)} of {nb_fragments} fragments already downloaded")
+
+    report(f"Downloading {nb_fragments} fragments, {workers} at a time")
+
+    with tempfile.TemporaryFile() as mux_errors:
+
+        mux = start_remux(output_file, mux_errors)
+
+        if mux is None:
+            report(f"Cannot start {FFMPEG_BIN_PATH}, fragments are saved without remuxing")
+
+        try:
+            with open(partpath, "r+b" if sizes else "wb") as part, \
+                 open(journalpath, "a" if sizes else "w", encoding="utf-8") as journal:
+
+                if sizes:
+                    part.truncate(sum(sizes))
+                    if mux is not None:
+                        # ffmpeg remuxes the whole stream again
+                        part.seek(0)
+                        while True:
+                            block = part.read(COPY_BLOCK_SIZE)
+                            if not block:
+                                break
+                            _feed_remux(mux, mux_errors, block)
+                    part.seek(sum(sizes))
+                else:
+                    journal.write(json.dumps({'fingerprint': fingerprint, 'fragments': nb_fragments}) + "\n")
+                    journal.flush()
+
+                next_report = PROGRESS_STEP
+
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+
+                    futures = {}
+                    next_fragment = len(sizes)
+
+                    try:
+                        for index in range(len(sizes), nb_fragments):
+
+                            # Only the fragments within the window of the one being written are downloaded ahead
+                            while next_fragment < nb_fragments and next_fragment < index + 2 * workers:
+                                futures[next_fragment] = executor.submit(fetch_fragment, fragments[next_fragment], headers, retries, job)
+                                next_fragment += 1
+
+                            data = futures.pop(index).result()
+
+                            part.write(data)
+                            part.flush()
+
+                            journal.write(f"{index} {len(data)}\n")
+                            journal.flush()
+
+                            if mux is not None:
+                                _feed_remux(mux, mux_errors, data)
+
+                            percent = 100 * (index + 1) // nb_fragments
+
+                            if percent >= next_report:
+                                next_report = (percent // PROGRESS_STEP + 1) * PROGRESS_STEP
+                                report(f"{percent}% downloaded")
+
+                    finally:
+                        # Do not start the fragments still waiting in the queue
+                        for pending in futures.values():
+                            pending.cancel()
+
+        except BaseException:
+            if mux is not None:
+                mux.kill()
+                mux.wait()
+            raise
+
+        if mux is not None:
+            mux.communicate()
+            if mux.returncode != 0:
+                raise _remux_error(mux_errors)
+            os.remove(partpath)
+        else:
+            os.replace(partpath, output_file)
+
+    os.remove(journalpath)
+
+    report("Download finished")
@@ -0,0 +1,130 @@
+"""
+HttpTransport.py
+
+Shared HTTP transport for the download scripts (GetVideoKMG, DownloadVideosCurl).
+Keeps one pooled keep-alive requests Session per host so connections and TLS
+sessions are reused across segments, tracks and videos.
+
+Usage:
+  import HttpTransport
+  HttpTransport.configure(pool_size=8, retries=3)
+  resp = HttpTransport.get(url, headers=hds)
+
+Notes:
+- The pool of a host blocks when all its connections are in use, so pool_size
+  is also the maximum number of simultaneous connections to one host.
+- Failed connections and 429/5xx answers are retried with exponential backoff.
+  The last response is returned as is, callers check resp.ok.
+"""
+
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of connections kept open to each host
+POOL_SIZE = 8
+
+# Number of retries of a failed request and base delay in seconds between retries
+RETRIES = 3
+BACKOFF = 0.5
+
+# Answers retried as temporary server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Timeouts in seconds to connect and to wait for data
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+settings = {
+    'pool_size': POOL_SIZE,
+    'retries': RETRIES,
+    'backoff': BACKOFF,
+    'connect_timeout': CONNECT_TIMEOUT,
+    'read_timeout': READ_TIMEOUT,
+}
+
+# One session per host
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def configure(pool_size=None, retries=None, backoff=None, connect_timeout=None, read_timeout=None):
+    """
+    Change the transport settings. Sessions already open are closed so the
+    next requests use the new settings.
+    """
+    new_settings = {
+        'pool_size': pool_size,
+        'retries': retries,
+        'backoff': backoff,
+        'connect_timeout': connect_timeout,
+        'read_timeout': read_timeout,
+    }
+
+    with sessions_lock:
+        settings.update({k: v for k, v in new_settings.items() if v is not None})
+        _close_sessions()
+
+
+def _new_session():
+    """
+    Create a session with a pool of keep-alive connections and retries.
+    """
+    retry = Retry(total=settings['retries'],
+                  backoff_factor=settings['backoff'],
+                  status_forcelist=RETRY_STATUS,
+                  allowed_methods=("GET", "HEAD"),
+                  raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=settings['pool_size'],
+                          pool_block=True,
+                          max_retries=retry)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
+
+
+def get_session(url: str):
+    """
+    Return the shared session used for the host of the URL.
+    """
+    parts = urlparse(url)
+    host = (parts.scheme, parts.netloc)
+
+    with sessions_lock:
+        if host not in sessions:
+            sessions[host] = _new_session()
+        return sessions[host]
+
+
+def get(url: str, headers=None, timeout=None, **kwargs):
+    """
+    GET the URL with the session of its host. Default timeout is
+    (CONNECT_TIMEOUT, READ_TIMEOUT).
+    """
+    if timeout is None:
+        timeout = (settings['connect_timeout'], settings['read_timeout'])
+
+    return get_session(url).get(url, headers=headers, timeout=timeout, **kwargs)
+
+
+def close():
+    """
+    Close all sessions and their connections.
+    """
+    with sessions_lock:
+        _close_sessions()
+
+
+def _close_sessions():
+    # Caller must hold sessions_lock
+    for session in sessions.values():
+        session.close()
+    sessions.clear()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+MockCdn.py
+
+Local HTTP server imitating the video CDN used by GetVideoKMG.py, to measure
+the downloader without the real CDN and its expiring signed URLs.
+
+It serves a synthetic playlist.json with the same clip_id/base_url/video/audio/segments
+schema as the real one, and segment bodies addressed by the range=<start>-<end> of
+their URL (or by a Range header). Latency, jitter, bandwidth caps and failures can be
+injected.
+
+Usage:
+  python MockCdn.py --port 8080 --latency 0.05 --jitter 0.02 --bandwidth 4
+  then download http://127.0.0.1:8080/<playlist path printed at start>
+
+  from MockCdn import start
+  server = start(latency=0.05, failure_rate=0.01)
+  url = playlist_url(server)
+
+Notes:
+- The byte at position p of every media file is p % 251, so the init segment followed
+  by the segments of a stream is one continuous pattern and downloads can be checked
+  with expected_body().
+- As in the real playlist.json, segment ranges are inclusive and the size of a segment
+  is end - start, one byte less than the body sent.
+"""
+
+import argparse
+import base64
+import http.server
+import json
+import logging
+import random
+import re
+import threading
+import time
+
+# Period of the pattern of the media files
+PATTERN_PERIOD = 251
+
+# Size of the blocks sent to the client
+BLOCK_SIZE = 64 * 1024
+
+PATTERN = bytes(range(PATTERN_PERIOD)) * (BLOCK_SIZE // PATTERN_PERIOD + 2)
+
+# Path of the playlist, as on the real CDN
+PLAYLIST_PATH = "/exp={expires}~acl=%2F{clip_id}%2F%2A~hmac=mock/{clip_id}/v2/playlist/av/primary/prot/cXNyPTE/playlist.json"
+
+# Sizes of the init segments, as in the sample playlist.json
+VIDEO_INIT_SIZE = 961
+AUDIO_INIT_SIZE = 838
+
+# Synthetic clip
+CLIP_ID = "00000000-mock-clip-0000-000000000000"
+DURATION = 60
+SEGMENT_DURATION = 6
+VIDEO_STREAMS = ((1920, 1080, 4637000), (1280, 720, 2400000), (960, 540, 1500000), (640, 360, 800000))
+AUDIO_STREAMS = (191000, 128000, 64000)
+
+logger = logging.getLogger(__name__)
+
+#
+# Bytes of a media file from start to end included, in blocks of at most BLOCK_SIZE
+#
+def body_blocks(start, end):
+
+    position = start
+
+    while position <= end:
+        length = min(BLOCK_SIZE, end + 1 - position)
+        offset = position % PATTERN_PERIOD
+        yield PATTERN[offset:offset + length]
+        position += length
+
+#
+# Expected content of a downloaded media file of the given size
+#
+def expected_body(size):
+
+    return b"".join(body_blocks(0, size - 1))
+
+#
+# Build one stream of the playlist. Segment sizes vary around bitrate * SEGMENT_DURATION
+#
+def synthetic_stream(stream_id, init_size, bitrate, duration, rand, **extra):
+
+    segments = []
+    start = init_size
+    time_start = 0
+
+    while time_start < duration:
+
+        time_end = min(duration, time_start + SEGMENT_DURATION)
+
+        size = max(1, int(bitrate * (time_end - time_start) / 8 * rand.uniform(0.9, 1.1)))
+        end = start + size
+
+        range_id = base64.urlsafe_b64encode(f"range={start}-{end}".encode()).decode().rstrip("=")
+
+        segments.append({
+            'start': time_start,
+            'end': time_end,
+            'url': f"{range_id}/avf/{stream_id}.mp4?pathsig=mock~{rand.getrandbits(64):x}&r=dXM%3D&range={start}-{end}",
+            'size': size,
+        })
+
+        start = end + 1
+        time_start = time_end
+
+    stream = {
+        'id': stream_id,
+        'avg_id': stream_id[:8],
+        'base_url': 'range/prot/',
+        'format': 'dash',
+        'bitrate': bitrate,
+        'avg_bitrate': bitrate,
+        'duration': duration,
+        'max_segment_duration': SEGMENT_DURATION,
+        'init_segment': base64.b64encode(expected_body(init_size)).decode(),
+        'init_segment_url': '',
+        'segments': segments,
+    }
+    stream.update(extra)
+
+    return stream
+
+#
+# Build a playlist with the same schema as the real playlist.json
+#
+def synthetic_playlist(clip_id=CLIP_ID, duration=DURATION, video_streams=VIDEO_STREAMS, audio_streams=AUDIO_STREAMS, seed=0):
+
+    rand = random.Random(seed)
+
+    video = [synthetic_stream(f"{index:08d}-video-{width}", VIDEO_INIT_SIZE, bitrate, duration, rand,
+                              mime_type='video/mp4', codecs='avc1.64002A', width=width, height=height)
+             for index, (width, height, bitrate) in enumerate(video_streams)]
+
+    audio = [synthetic_stream(f"{index:08d}-audio-{bitrate}", AUDIO_INIT_SIZE, bitrate, duration, rand,
+                              mime_type='audio/mp4', codecs='mp4a.40.2', channels=2, sample_rate=48000)
+             for index, bitrate in enumerate(audio_streams)]
+
+    return {'clip_id': clip_id, 'base_url': '../../../../../', 'video': video, 'audio': audio}
+
+#
+# Limit the rate of the bytes sent. Shared by several responses, it limits their total rate
+#
+class Pacer:
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self, nbytes):
+
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now) + nbytes / self.rate
+            delay = self.next_time - now
+
+        time.sleep(delay)
+
+#
+# Counters of the requests served, reset between measures
+#
+class CdnStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.failures = 0
+            self.bytes = 0
+            self.latencies = []
+
+    def add(self, nbytes, seconds, failed):
+        with self.lock:
+            self.requests += 1
+            self.failures += failed
+            self.bytes += nbytes
+            self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': self.requests, 'failures': self.failures, 'bytes': self.bytes,
+                    'latencies': list(self.latencies)}
+
+
+class MockCdnHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_body(self, status, data):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def requested_range(self):
+
+        match = re.search(r"[?&]range=(\d+)-(\d+)", self.path)
+
+        if match is None:
+            match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+
+        if match is None:
+            return None
+
+        return int(match.group(1)), int(match.group(2))
+
+    def do_GET(self):
+
+        server = self.server
+        settings = server.settings
+
+        started = time.monotonic()
+
+        delay = settings['latency'] + server.rand.uniform(-settings['jitter'], settings['jitter'])
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.path.split("?", 1)[0].endswith("/playlist.json"):
+            self.send_body(200, server.playlist_data)
+            return
+
+        byte_range = self.requested_range()
+
+        if byte_range is None or byte_range[1] < byte_range[0]:
+            self.send_body(404, b"")
+            server.stats.add(0, time.monotonic() - started, True)
+            return
+
+        start, end = byte_range
+
+        if server.rand.random() < settings['failure_rate']:
+            self.send_body(503, b"")
+            server.stats.add(0, time.monotonic() - started, True)
+            return
+
+        if settings['max_range'] and end + 1 - start > settings['max_range']:
+            self.send_body(416, b"")
+            server.stats.add(0, time.monotonic() - started, True)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.end_headers()
+
+        connection = Pacer(settings['bandwidth'])
+
+        try:
+            for block in body_blocks(start, end):
+                connection.wait(len(block))
+                server.link.wait(len(block))
+                self.wfile.write(block)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client gave up, for example a lost duplicate request
+            server.stats.add(0, time.monotonic() - started, True)
+            self.close_connection = True
+            return
+
+        server.stats.add(end + 1 - start, time.monotonic() - started, False)
+
+class MockCdnServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    # Clients closing their keep-alive connections are not errors
+    def handle_error(self, request, client_address):
+        logger.debug(f"Connection from {client_address} closed", exc_info=True)
+
+#
+# Start the mock CDN in a background thread. latency and jitter are in seconds, bandwidth
+# (per response) and link_bandwidth (all responses) in bytes per second, 0 for no limit.
+# Ranges larger than max_range bytes are refused, like a CDN refusing merged ranges
+#
+def start(host="127.0.0.1", port=0, playlist=None, latency=0.0, jitter=0.0, bandwidth=0, link_bandwidth=0,
+          failure_rate=0.0, max_range=0, seed=0):
+
+    server = MockCdnServer((host, port), MockCdnHandler)
+
+    server.playlist = playlist if playlist is not None else synthetic_playlist(seed=seed)
+    server.playlist_data = json.dumps(server.playlist).encode("utf-8")
+    server.settings = {'latency': latency, 'jitter': jitter, 'bandwidth': bandwidth,
+                       'failure_rate': failure_rate, 'max_range': max_range}
+    server.link = Pacer(link_bandwidth)
+    server.stats = CdnStats()
+    server.rand = random.Random(seed)
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+#
+# URL of the playlist served, with an expiry one hour from now like the real signed URLs
+#
+def playlist_url(server, expires=None):
+
+    if expires is None:
+        expires = int(time.time()) + 3600
+
+    host, port = server.server_address[:2]
+    path = PLAYLIST_PATH.format(expires=expires, clip_id=server.playlist['clip_id'])
+
+    return f"http://{host}:{port}{path}?omit=av1-hevc&pathsig=mock&qsr=1&r=dXM%3D"
+
+
+# main program
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on (default 8080)")
+    parser.add_argument("--duration", type=int, default=DURATION, help="Duration in seconds of the synthetic clip (default 60)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before each answer (default 0)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random variation in seconds of the latency (default 0)")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Maximum MiB/s of one response, 0 for no limit (default 0)")
+    parser.add_argument("--link-bandwidth", type=float, default=0, help="Maximum MiB/s of all responses, 0 for no limit (default 0)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of segment requests answered with 503 (default 0)")
+    parser.add_argument("--max-range", type=int, default=0, help="Refuse ranges larger than this size in MiB, 0 for no limit (default 0)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic playlist and of the injected faults (default 0)")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s-%(name)s-%(levelname)s:%(message)s', level=logging.INFO)
+
+    server = start(args.host, args.port, synthetic_playlist(duration=args.duration, seed=args.seed),
+                   args.latency, args.jitter, args.bandwidth * 1024 * 1024, args.link_bandwidth * 1024 * 1024,
+                   args.failure_rate, args.max_range * 1024 * 1024, args.seed)
+
+    logger.info(f"Playlist URL {playlist_url(server)}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,246 @@
+"""
+RateLimiter.py
+
+Token bucket limiting the download rate of the download scripts (GetVideoKMG,
+DownloadVideosCurl), so large batches can run without saturating the uplink.
+The global rate is shared by all the downloads of the process, and each job
+(a video downloaded in parallel with others) is limited to its fair share.
+
+Usage:
+  import RateLimiter
+  limiter = RateLimiter.RateLimiter(RateLimiter.parse_rate("2M"), control_file="rate.txt")
+  limiter.install_signal()
+  with limiter.join() as job:
+      for block in blocks:
+          job.consume(len(block))
+
+Notes:
+- Rates are in bytes per second, 0 for no limit. parse_rate accepts suffixes K, M
+  and G (1024 based), as curl --limit-rate and yt-dlp --limit-rate do.
+- The control file holds one rate, for example "500K". It is checked every
+  CONTROL_INTERVAL seconds and read at once on SIGUSR1, so the rate of a running
+  batch can be changed with: echo 500K > rate.txt
+- The fair share of a job is the global rate divided by the number of jobs joined.
+  A job can use less, the rest is not given to the other jobs.
+- The limit applies to one process. Processes sharing the uplink can share the
+  same control file, each one then gets the rate it contains.
+"""
+
+import os
+import re
+import signal
+import threading
+import time
+
+# Seconds of traffic at full rate allowed in one burst
+BURST = 0.5
+
+# Seconds between two checks of the control file
+CONTROL_INTERVAL = 2.0
+
+_RATE = re.compile(r"\s*(\d+(?:\.\d*)?)\s*([kKmMgG]?)(?:i?B)?\s*")
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(text: str) -> int:
+    """
+    Bytes per second of a rate like "500K", "2.5M" or "1048576". Empty is no limit.
+    """
+    if text is None or not str(text).strip():
+        return 0
+
+    match = _RATE.fullmatch(str(text))
+
+    if match is None:
+        raise ValueError(f"invalid rate '{text}', expected a number with an optional K, M or G suffix")
+
+    return int(float(match.group(1)) * _UNITS[match.group(2).lower()])
+
+
+def format_rate(rate: int) -> str:
+    """
+    Readable form of a rate in bytes per second.
+    """
+    if not rate:
+        return "unlimited"
+
+    for suffix, unit in (("G", 1024 ** 3), ("M", 1024 ** 2), ("K", 1024)):
+        if rate >= unit:
+            return f"{rate / unit:.1f}{suffix}/s"
+
+    return f"{rate}/s"
+
+
+class _Bucket:
+    """
+    Token bucket as a virtual time: the time at which the bytes consumed so far
+    are paid at the given rate. Caller holds the lock of the limiter.
+    """
+
+    def __init__(self):
+        self.next_time = time.monotonic()
+
+    def reserve(self, nbytes, rate, now):
+        """
+        Take nbytes and return the seconds to wait before using them.
+        """
+        self.next_time = max(self.next_time, now) + nbytes / rate
+        return max(0.0, self.next_time - now - BURST)
+
+
+class JobShare:
+    """
+    Fair share of one job of the limiter. Leave it with close() or use it as a context manager.
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.bucket = _Bucket()
+
+    @property
+    def rate(self):
+        """
+        Current fair share of the job in bytes per second, 0 for no limit.
+        """
+        return self.limiter.share()
+
+    def consume(self, nbytes):
+        self.limiter.consume(nbytes, self)
+
+    def close(self):
+        self.limiter.leave(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RateLimiter:
+    """
+    Global token bucket shared by the downloads of the process. Used from several threads.
+    """
+
+    def __init__(self, rate: int = 0, control_file: str = None):
+        self.rate = rate
+        self.control_file = control_file
+        self.lock = threading.Lock()
+        # Notified when the rate changes, to wake up the downloads waiting at the old rate
+        self.rate_changed = threading.Condition(self.lock)
+        self.bucket = _Bucket()
+        self.jobs = []
+        self.control_mtime = None
+        self.next_check = 0.0
+
+        if control_file:
+            self.reload()
+
+    def set_rate(self, rate: int):
+        with self.lock:
+            self._change_rate(rate)
+
+    def _change_rate(self, rate):
+        # Caller must hold lock
+        if rate == self.rate:
+            return
+        self.rate = rate
+        # Bytes reserved at the old rate are forgotten
+        self.bucket = _Bucket()
+        for job in self.jobs:
+            job.bucket = _Bucket()
+        self.rate_changed.notify_all()
+
+    def reload(self):
+        """
+        Read the rate in the control file if it changed. A missing or invalid file keeps the current rate.
+        """
+        try:
+            mtime = os.stat(self.control_file).st_mtime_ns
+            if mtime == self.control_mtime:
+                return
+            with open(self.control_file, encoding="utf-8") as f:
+                rate = parse_rate(f.read())
+        except (OSError, ValueError):
+            return
+
+        with self.lock:
+            self.control_mtime = mtime
+            self._change_rate(rate)
+
+    def install_signal(self, signum=getattr(signal, 'SIGUSR1', None)):
+        """
+        Read the control file at once when signum is received. Call from the main thread.
+        """
+        if signum is None or not self.control_file:
+            return
+
+        def handler(received, frame):
+            # Read on the next consume, a signal handler must not wait for the lock
+            self.control_mtime = None
+            self.next_check = 0.0
+
+        signal.signal(signum, handler)
+
+    def join(self) -> JobShare:
+        """
+        Register a job, which gets its fair share of the rate until it leaves.
+        """
+        job = JobShare(self)
+
+        with self.lock:
+            self.jobs.append(job)
+
+        return job
+
+    def leave(self, job: JobShare):
+        with self.lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+
+    def check_control(self):
+        """
+        Read the control file if it is time to check it again.
+        """
+        now = time.monotonic()
+
+        if self.control_file and now >= self.next_check:
+            self.next_check = now + CONTROL_INTERVAL
+            self.reload()
+
+    def share(self):
+        """
+        Fair share of each job in bytes per second, 0 for no limit.
+        """
+        self.check_control()
+
+        with self.lock:
+            return self.rate // max(1, len(self.jobs)) if self.rate else 0
+
+    def consume(self, nbytes: int, job: JobShare = None):
+        """
+        Wait until nbytes can be used within the global rate and the share of the job.
+        """
+        self.check_control()
+
+        now = time.monotonic()
+
+        with self.lock:
+            if not self.rate:
+                return
+            delay = self.bucket.reserve(nbytes, self.rate, now)
+            if job is not None:
+                delay = max(delay, job.bucket.reserve(nbytes, self.rate / max(1, len(self.jobs)), now))
+
+            # Waits at most CONTROL_INTERVAL at a time so a new rate in the control file is seen
+            rate = self.rate
+            end = now + delay
+            while rate == self.rate and delay > 0:
+                self.rate_changed.wait(min(delay, CONTROL_INTERVAL))
+                delay = end - time.monotonic()
+                if delay > 0 and self.control_file and time.monotonic() >= self.next_check:
+                    self.lock.release()
+                    try:
+                        self.check_control()
+                    finally:
+                        self.lock.acquire()
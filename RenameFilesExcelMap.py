@@ -2,7 +2,7 @@
 
 import os
 from pathlib import Path, PurePath
-import glob
+import FileWalker
 import argparse
 from openpyxl import load_workbook
 import csv
@@ -76,9 +76,7 @@ def main(args):
 	for key, value in file_map.items():
 		print(f"{key}: {value}")
       
-	globarg = sourcefolder + '/**/' + filter
-
-	files = glob.glob(globarg, recursive = True)
+	files = FileWalker.glob_files(sourcefolder, filter)
      
 	nb_files_renamed = 0
 
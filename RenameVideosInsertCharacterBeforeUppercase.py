@@ -4,7 +4,7 @@
 
 import os
 from pathlib import Path, PurePath
-import glob
+import FileWalker
 import argparse
 import re
 
@@ -25,9 +25,7 @@ def main(args):
 	else:
 		filter = '*.mp4'
 
-	globarg = sourcefolder + '/**/' + filter
-
-	files = glob.glob(globarg, recursive = True)
+	files = FileWalker.glob_files(sourcefolder, filter)
 
 	nb_files_renamed = 0
 
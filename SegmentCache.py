@@ -0,0 +1,145 @@
+"""
+SegmentCache.py
+
+On-disk cache of downloaded media segments shared by reruns of GetVideoKMG.py and by
+videos appearing in several CSV files. Segments are keyed by their resource id and byte
+range, not by the signed query string of their URL which changes quite often.
+
+Usage:
+  import SegmentCache
+  cache = SegmentCache.SegmentCache("~/.cache/getvideokmg", max_bytes=2 * 1024**3)
+  data = cache.get("avf/<id>.mp4", 961, 2357385)
+  if data is None:
+      data = ...
+      cache.put("avf/<id>.mp4", 961, 2357385, data)
+
+Notes:
+- The total size is kept under max_bytes by removing the least recently used segments.
+  A hit marks the segment as recently used by updating its modification time, so the
+  order survives between runs.
+- Segments are written to a temporary file then renamed, so a reader never sees a
+  partial segment, even from another process.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Default maximum size of the cache
+MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+SEGMENT_EXTENSION = ".seg"
+
+
+class SegmentCache:
+    """
+    Segments stored in folder, at most max_bytes in total. Used from several threads.
+    """
+
+    def __init__(self, folder: str, max_bytes: int = MAX_BYTES):
+        self.folder = os.path.expandvars(os.path.expanduser(folder))
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Path and size of each segment, least recently used first
+        self.entries = OrderedDict()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.folder, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        found = []
+
+        for subfolder in os.scandir(self.folder):
+            if not subfolder.is_dir():
+                continue
+            for entry in os.scandir(subfolder.path):
+                if entry.name.endswith(SEGMENT_EXTENSION):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.path, stat.st_size))
+
+        for _, path, size in sorted(found):
+            self.entries[path] = size
+            self.total += size
+
+        with self.lock:
+            self._evict()
+
+    def path(self, resource: str, start: int, end: int) -> str:
+        """
+        Path of the file of a segment.
+        """
+        key = hashlib.sha1(f"{resource}:{start}-{end}".encode("utf-8")).hexdigest()
+        return os.path.join(self.folder, key[:2], key + SEGMENT_EXTENSION)
+
+    def get(self, resource: str, start: int, end: int):
+        """
+        Return the bytes of a segment, None if it is not in the cache.
+        """
+        path = self.path(resource, start, end)
+
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+                if path in self.entries:
+                    self.total -= self.entries.pop(path)
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if path in self.entries:
+                self.entries.move_to_end(path)
+            else:
+                # Added by another process
+                self.entries[path] = len(data)
+                self.total += len(data)
+                self._evict()
+
+        return data
+
+    def put(self, resource: str, start: int, end: int, data):
+        """
+        Store the bytes of a segment, removing the least recently used ones if needed.
+        """
+        if len(data) > self.max_bytes:
+            return
+
+        path = self.path(resource, start, end)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.replace(temppath, path)
+        except OSError:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+
+        with self.lock:
+            if path in self.entries:
+                self.total -= self.entries.pop(path)
+            self.entries[path] = len(data)
+            self.total += len(data)
+            self._evict()
+
+    def _evict(self):
+        # Caller must hold lock
+        while self.total > self.max_bytes and self.entries:
+            path, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(path)
+            except OSError:
+                pass
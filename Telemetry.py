@@ -0,0 +1,211 @@
+"""
+Telemetry.py
+
+Timing and byte counters of the download stages of GetVideoKMG.py (playlist fetch,
+segment fetch, init segment decode, file and pipe writes, ffmpeg merge), aggregated
+into histograms per video and per batch. Written as a JSON report and as a Prometheus
+textfile collector file, to see whether a download is CDN, disk or merge bound.
+
+Usage:
+  import Telemetry
+  stats = Telemetry.Telemetry()
+  with stats.measure("segment_fetch") as sample:
+      data = ...
+      sample.nbytes = len(data)
+  batch = Telemetry.Telemetry()
+  batch.merge(stats)
+  Telemetry.write_json("report.json", batch, {"video": stats})
+  Telemetry.write_prometheus("getvideokmg.prom", batch, {"video": stats})
+
+Notes:
+- Histogram buckets are upper bounds in seconds. Counts are per bucket in the JSON
+  report and cumulative in the Prometheus file, as Prometheus expects.
+- The Prometheus file is written to a temporary file then renamed, so the node
+  exporter never reads a partial file.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets. Last bucket has no bound
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# Prefix of the Prometheus metric names
+METRIC_PREFIX = "getvideokmg"
+
+
+class Histogram:
+    """
+    Distribution of the durations of one stage, with the number of bytes it handled.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def observe(self, seconds, nbytes=0):
+        index = 0
+        while index < len(BUCKETS) and seconds > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+
+    def merge(self, other):
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+
+    def quantile(self, percent):
+        """
+        Upper bound of the bucket holding the given percentile, None if empty.
+        """
+        if not self.count:
+            return None
+
+        rank = self.count * percent / 100
+        total = 0
+
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+
+        return float("inf")
+
+    def to_dict(self):
+        p50 = self.quantile(50)
+        p99 = self.quantile(99)
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'mib_per_s': self.bytes / self.seconds / (1024 * 1024) if self.seconds else None,
+            'p50_seconds': p50 if p50 != float("inf") else None,
+            'p99_seconds': p99 if p99 != float("inf") else None,
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS + ("+Inf",), self.counts)},
+        }
+
+
+class Sample:
+    """
+    Bytes handled by one measured operation, set by the caller.
+    """
+
+    def __init__(self):
+        self.nbytes = 0
+
+
+class Telemetry:
+    """
+    Histograms of the stages of one video or of a batch. Updated from several threads.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds, nbytes=0):
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds, nbytes)
+
+    @contextmanager
+    def measure(self, stage):
+        """
+        Time the block and record it in stage with the bytes set in the sample.
+        """
+        sample = Sample()
+        start = time.perf_counter()
+        try:
+            yield sample
+        finally:
+            self.record(stage, time.perf_counter() - start, sample.nbytes)
+
+    def merge(self, other):
+        with other.lock:
+            stages = {stage: histogram for stage, histogram in other.stages.items()}
+
+        with self.lock:
+            for stage, histogram in stages.items():
+                if stage not in self.stages:
+                    self.stages[stage] = Histogram()
+                self.stages[stage].merge(histogram)
+
+    def to_dict(self):
+        with self.lock:
+            return {stage: histogram.to_dict() for stage, histogram in sorted(self.stages.items())}
+
+
+def write_json(path: str, batch: Telemetry, videos: dict):
+    """
+    Write the batch and per video histograms as a JSON report.
+    """
+    report = {
+        'batch': batch.to_dict(),
+        'videos': {name: telemetry.to_dict() for name, telemetry in videos.items()},
+    }
+
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def write_prometheus(path: str, batch: Telemetry, videos: dict):
+    """
+    Write the batch histograms and the per video totals in the Prometheus text format.
+    """
+    lines = [
+        f"# HELP {METRIC_PREFIX}_stage_seconds Duration of the download stages of the batch.",
+        f"# TYPE {METRIC_PREFIX}_stage_seconds histogram",
+    ]
+
+    with batch.lock:
+        stages = sorted(batch.stages.items())
+
+        for stage, histogram in stages:
+            total = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                total += count
+                lines.append(f"{METRIC_PREFIX}_stage_seconds_bucket{{stage=\"{stage}\",le=\"{bound}\"}} {total}")
+            lines.append(f"{METRIC_PREFIX}_stage_seconds_sum{{stage=\"{stage}\"}} {histogram.seconds}")
+            lines.append(f"{METRIC_PREFIX}_stage_seconds_count{{stage=\"{stage}\"}} {histogram.count}")
+
+        lines.append(f"# HELP {METRIC_PREFIX}_stage_bytes_total Bytes handled by the download stages of the batch.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_stage_bytes_total counter")
+
+        for stage, histogram in stages:
+            lines.append(f"{METRIC_PREFIX}_stage_bytes_total{{stage=\"{stage}\"}} {histogram.bytes}")
+
+    lines.append(f"# HELP {METRIC_PREFIX}_video_stage_seconds_total Time spent in each stage for each video.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_video_stage_seconds_total counter")
+    video_bytes = []
+
+    for name, telemetry in sorted(videos.items()):
+        with telemetry.lock:
+            for stage, histogram in sorted(telemetry.stages.items()):
+                labels = f"video=\"{_label(name)}\",stage=\"{stage}\""
+                lines.append(f"{METRIC_PREFIX}_video_stage_seconds_total{{{labels}}} {histogram.seconds}")
+                video_bytes.append(f"{METRIC_PREFIX}_video_stage_bytes_total{{{labels}}} {histogram.bytes}")
+
+    lines.append(f"# HELP {METRIC_PREFIX}_video_stage_bytes_total Bytes handled in each stage for each video.")
+    lines.append(f"# TYPE {METRIC_PREFIX}_video_stage_bytes_total counter")
+    lines.extend(video_bytes)
+
+    temppath = path + ".tmp"
+
+    with open(temppath, "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
+
+    os.replace(temppath, path)